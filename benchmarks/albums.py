@@ -0,0 +1,70 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre benchmarks albums
+
+Generate a tree of synthetic albums made of silent audio files.
+"""
+
+import os
+import shutil
+
+from wlg.mediafile import Track
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                         'test', 'data')
+
+FORMATS = ('flac', 'mp3', 'm4a', 'ogg')
+
+
+def make_albums(path, num, tracks=4, artists=None, formats=FORMATS):
+    """Create num album directories in path and return their paths.
+
+    Every album consists of tracks copies of a silent file of one of
+    the formats with artist, album, date and track metadata set.
+    Artists repeat every artists albums (default: every 3rd album
+    has a new artist), like in a real music library.
+
+    :param path: directory to create the albums in
+    :param num: number of albums
+    :param tracks: number of tracks per album
+    :param artists: number of different artists
+    :param formats: file formats to use in turn
+    """
+    artists = artists or max(1, num // 3)
+    paths = []
+    for i in range(num):
+        ext = formats[i % len(formats)]
+        artist = 'Artist %d' % (i % artists)
+        album = 'Album %d' % i
+        album_path = os.path.join(path, '%s - %s' % (artist, album))
+        os.makedirs(album_path)
+        for j in range(1, tracks + 1):
+            filename = '%02d - Track %d.%s' % (j, j, ext)
+            shutil.copy(os.path.join(DATA_PATH, 'silence.' + ext),
+                        os.path.join(album_path, filename))
+            track = Track(album_path, filename)
+            track.set_meta('artist', artist)
+            track.set_meta('album', album)
+            track.set_meta('date', str(1970 + i % 47))
+            track.set_meta('title', 'Track %d' % j)
+            track.set_meta('tracknumber', str(j))
+            # no genre metadata, so every album gets changed
+            track.set_meta('genre', None)
+            track.save()
+        paths.append(album_path)
+    return paths
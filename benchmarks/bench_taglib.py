@@ -0,0 +1,228 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre taglib benchmarks
+
+Feed large generated tag dicts through the TagLib using the shipped
+whitelist and tagsfile.  Run with pytest, pytest-benchmark is used if
+installed (e.g. with --benchmark-autosave to compare runs over time),
+otherwise the results get appended to .benchmarks/microbench.jsonl:
+
+    python -m pytest benchmarks/bench_taglib.py
+"""
+
+import atexit
+import os
+import random
+import shutil
+import tempfile
+from argparse import Namespace
+
+import pytest
+
+from wlg.cache import TagCache
+from wlg.whatlastgenre import Config, TagLib, WhatLastGenre, \
+    preprocess_tags, tags_version
+
+from . import microbench, replay
+from .run import write_config
+
+# the stand-in fixture, unless pytest-benchmark provides it
+benchmark = microbench.fixture()
+
+DELIMITERS = [', ', ' / ', '; ', ' & ', ' and ', '_', '.']
+
+NOISE = ['seen live', 'favorite albums', 'albums i own', 'awesome',
+         '1990s', '00s', 'female vocalists', 'british', 'beautiful',
+         'under 2000 listeners', 'check out', 'vinyl', 'my top 100']
+
+
+def get_wlg():
+    """Return a WhatLastGenre object with the shipped whitelist and
+    tagsfile, set up in a temporary home directory.
+    """
+    home = tempfile.mkdtemp(prefix='wlg_bench_')
+    atexit.register(shutil.rmtree, home, True)
+    write_config(home, 'lastfm')
+    environ = os.environ.copy()
+    os.environ['HOME'] = home
+    try:
+        conf = Config(Namespace(
+            tag_limit=4, verbose=0, update_cache=False, interactive=False,
+            dry=True, difflib=False, release=False, jobs=1, plan=False,
+            incremental=False, journal=False))
+        return WhatLastGenre(conf)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def fixture_tags():
+    """Return the tag names of the replayed API responses."""
+    tags = set()
+    for source in replay.load_fixtures().values():
+        for responses in source.values():
+            for response in responses:
+                collect_tags(response, tags)
+    return sorted(tags)
+
+
+def collect_tags(data, tags):
+    """Collect tag names from all tag lists of a json response."""
+    if isinstance(data, dict):
+        for key, val in data.items():
+            if key in ['tag', 'tags', 'genre', 'style'] \
+                    and isinstance(val, list):
+                tags.update(t['name'] if isinstance(t, dict) else t
+                            for t in val)
+            else:
+                collect_tags(val, tags)
+    elif isinstance(data, list):
+        for val in data:
+            collect_tags(val, tags)
+
+
+def make_tag(rnd, whitelist, aliases, fixture):
+    """Return a raw tag like the music sites deliver them."""
+    choice = rnd.random()
+    if choice < .4:
+        return rnd.choice(whitelist)
+    if choice < .5:
+        return rnd.choice(aliases)
+    if choice < .65:
+        tag = rnd.choice(whitelist)
+        return rnd.choice([tag.upper(), tag.title(), tag.replace(' ', '.'),
+                           tag.replace(' ', '-'), tag.replace('-', ' ')])
+    if choice < .8:
+        return rnd.choice(fixture)
+    if choice < .9:
+        return rnd.choice(DELIMITERS).join(rnd.sample(whitelist, 2))
+    return rnd.choice(NOISE)
+
+
+def make_tag_dicts(rnd, num, make_key, size=(5, 80)):
+    """Return num tag dicts, most of them with counts."""
+    dicts = []
+    for _ in range(num):
+        counts = rnd.random() < .8
+        dicts.append({make_key(): rnd.randint(0, 100) if counts else 0
+                      for _ in range(rnd.randint(*size))})
+    return dicts
+
+
+@pytest.fixture(scope='module')
+def inputs():
+    """Return a Namespace of the WhatLastGenre object and the generated
+    tag dicts, built once for all benchmarks.
+    """
+    wlg = get_wlg()
+    whitelist = sorted(wlg.whitelist)
+    aliases = sorted(k for k, _ in wlg.tags['alias'])
+    words = sorted(set(w for t in whitelist for w in t.split(' ')
+                       if len(w) > 2))
+    rnd = random.Random(42)
+    fixture = fixture_tags()
+    tag_dicts = make_tag_dicts(
+        rnd, 300, lambda: make_tag(rnd, whitelist, aliases, fixture))
+    preprocessed = [preprocess_tags(tags) for tags in tag_dicts]
+    return Namespace(
+        wlg=wlg,
+        tag_dicts=tag_dicts,
+        preprocessed=preprocessed,
+        keys=sorted(set(k for tags in preprocessed for k in tags)),
+        # pathological inputs
+        long_tags=make_tag_dicts(
+            rnd, 20,
+            lambda: ' '.join(rnd.sample(words, rnd.randint(6, 12))),
+            (5, 20)),
+        delimited_tags=make_tag_dicts(
+            rnd, 20, lambda: ''.join(
+                t + rnd.choice(DELIMITERS)
+                for t in rnd.sample(whitelist, rnd.randint(6, 12))).strip(),
+            (5, 20)))
+
+
+def get_taglib(wlg, tagcache=None):
+    """Return a new TagLib."""
+    return TagLib(wlg.conf, wlg.whitelist, wlg.tags, tagcache)
+
+
+def add_all(wlg, dicts, preprocess=True):
+    """Add all tag dicts to a new TagLib alternating the tag groups."""
+    taglib = get_taglib(wlg)
+    for i, tags in enumerate(dicts):
+        if preprocess:
+            tags = preprocess_tags(tags)
+        tags = taglib.score(tags, 1.0)
+        taglib.add(tags, 'artist' if i % 2 else 'album')
+    return taglib
+
+
+def run(benchmark, func, *args):
+    """Benchmark func and measure the allocations of one call."""
+    result = benchmark(func, *args)
+    benchmark.extra_info.update(microbench.measure_allocations(func, *args))
+    return result
+
+
+def test_preprocess_tags(benchmark, inputs):
+    run(benchmark, lambda: [preprocess_tags(t) for t in inputs.tag_dicts])
+
+
+def test_score(benchmark, inputs):
+    taglib = get_taglib(inputs.wlg)
+    run(benchmark,
+        lambda: [taglib.score(t, 1.0) for t in inputs.preprocessed])
+
+
+def test_resolve(benchmark, inputs):
+    taglib = get_taglib(inputs.wlg)
+    result = run(benchmark, lambda: [taglib.resolve(k) for k in inputs.keys])
+    assert len(result) == len(inputs.keys)
+
+
+def test_resolve_tagcache(benchmark, inputs):
+    wlg = inputs.wlg
+    tagcache = TagCache(tempfile.gettempdir(),
+                        tags_version(wlg.whitelist, wlg.tags))
+    tagcache.save = lambda: None  # keep it in memory
+    taglib = get_taglib(wlg, tagcache)
+    run(benchmark, lambda: [taglib.resolve(k) for k in inputs.keys])
+
+
+def test_split(benchmark, inputs):
+    taglib = get_taglib(inputs.wlg)
+    run(benchmark, lambda: [taglib.split_parts(k) for k in inputs.keys])
+
+
+def test_add(benchmark, inputs):
+    taglib = run(benchmark, add_all, inputs.wlg, inputs.tag_dicts)
+    assert taglib.taggrps['artist'] and taglib.taggrps['album']
+
+
+@pytest.mark.parametrize('various', [False, True])
+def test_merge(benchmark, inputs, various):
+    taglib = add_all(inputs.wlg, inputs.tag_dicts)
+    run(benchmark, taglib.merge, various)
+
+
+def test_add_long_multiword(benchmark, inputs):
+    run(benchmark, add_all, inputs.wlg, inputs.long_tags, False)
+
+
+def test_add_delimited(benchmark, inputs):
+    run(benchmark, add_all, inputs.wlg, inputs.delimited_tags, False)
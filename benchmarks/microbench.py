@@ -0,0 +1,118 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre benchmarks microbench
+
+Minimal stand-in for the benchmark fixture of pytest-benchmark, used
+if it isn't installed, and allocation measuring for both.
+"""
+
+import importlib.util
+import json
+import os
+import time
+import tracemalloc
+
+import pytest
+
+# where the stand-in appends its results
+HISTORY = os.path.join('.benchmarks', 'microbench.jsonl')
+
+
+def measure_allocations(func, *args, **kwargs):
+    """Call func once while tracing memory allocations.
+
+    Return a dict of the peak of the memory allocated during the call
+    and of the memory still allocated after it (in bytes).
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func(*args, **kwargs)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return {'alloc_peak': peak - before, 'alloc_kept': current - before}
+
+
+class Benchmark(object):
+    """Call a function repeatedly and record its timings.
+
+    Works like calling the benchmark fixture of pytest-benchmark: the
+    function gets called in rounds until min_time seconds passed (at
+    least min_rounds times) and the result of the last call is
+    returned.
+    """
+
+    def __init__(self, name, min_rounds=5, min_time=.5):
+        self.name = name
+        self.min_rounds = min_rounds
+        self.min_time = min_time
+        self.extra_info = {}
+        self.stats = None
+
+    def __call__(self, func, *args, **kwargs):
+        times = []
+        start = time.perf_counter()
+        while len(times) < self.min_rounds \
+                or time.perf_counter() - start < self.min_time:
+            time_ = time.perf_counter()
+            result = func(*args, **kwargs)
+            times.append(time.perf_counter() - time_)
+        mean = sum(times) / len(times)
+        self.stats = {'rounds': len(times), 'min': min(times),
+                      'max': max(times), 'mean': mean, 'ops': 1 / mean}
+        return result
+
+    def record(self):
+        """Return a dict of the results to keep in the history."""
+        return {'name': self.name, 'time': time.time(),
+                'stats': self.stats, 'extra_info': self.extra_info}
+
+
+def fixture():
+    """Return the stand-in benchmark fixture or None if pytest-benchmark
+    is installed and provides it.
+    """
+    if importlib.util.find_spec('pytest_benchmark'):
+        return None
+    return pytest.fixture(name='benchmark')(benchmark)
+
+
+def benchmark(request):
+    """Benchmark fixture that appends its results to HISTORY."""
+    bench = Benchmark(request.node.name)
+    yield bench
+    if not bench.stats:
+        return
+    os.makedirs(os.path.dirname(HISTORY), exist_ok=True)
+    with open(HISTORY, 'a') as file_:
+        file_.write(json.dumps(bench.record(), sort_keys=True) + '\n')
+    plugins = request.config.pluginmanager
+    reporter = plugins.get_plugin('terminalreporter')
+    capture = plugins.get_plugin('capturemanager')
+    if reporter and capture:
+        with capture.global_and_fixture_disabled():
+            reporter.write_line(
+                '%-32s %10.1f ops/s %10.3f ms %10.1f KiB peak'
+                % (bench.name, bench.stats['ops'],
+                   bench.stats['mean'] * 1000,
+                   bench.extra_info.get('alloc_peak', 0) / 1024))
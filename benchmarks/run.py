@@ -0,0 +1,220 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre benchmarks
+
+Run whatlastgenre on generated albums with replayed API responses,
+first with an empty cache, then again with the filled cache, and
+report throughput, requests, cache hits and time spent per stage.
+
+Usage: python -m benchmarks.run [-h] [-a N] [-t N] [-l SEC] [-j N] ...
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from argparse import Namespace
+from collections import defaultdict
+from contextlib import closing, redirect_stdout
+
+from wlg import dataprovider, pipeline
+from wlg.whatlastgenre import Config, WhatLastGenre
+
+from . import albums, replay
+
+if dataprovider.requests_cache:
+    # replayed responses must not come from the requests cache
+    dataprovider.requests_cache.uninstall_cache()
+
+STAGES = ('load_album', 'query_album', 'save_album')
+
+
+def write_config(home, sources):
+    """Write a config file with dummy credentials, so no source asks
+    for authentication.
+    """
+    path = os.path.join(home, '.whatlastgenre')
+    os.makedirs(path, exist_ok=True)
+    config = configparser.ConfigParser()
+    for section, option, value in Config.conf:
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+    config.set('wlg', 'sources', sources)
+    config.set('discogs', 'token', 'benchmark')
+    config.set('discogs', 'secret', 'benchmark')
+    config.set('redacted', 'session', 'benchmark')
+    with open(os.path.join(path, 'config'), 'w') as file_:
+        config.write(file_)
+
+
+class StageTimer(object):
+    """Measure the time spent in the stage methods of a WhatLastGenre
+    object, also when called from concurrent threads.
+    """
+
+    def __init__(self, wlg):
+        self.lock = threading.Lock()
+        self.times = defaultdict(float)
+        for stage in STAGES:
+            setattr(wlg, stage, self.wrap(stage, getattr(wlg, stage)))
+
+    def wrap(self, stage, func):
+        """Return func wrapped to add its run time to the stage."""
+
+        def timed(*args, **kwargs):
+            """Call func and record the time."""
+            time_ = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.times[stage] += time.time() - time_
+
+        return timed
+
+
+def run(args, paths, adapter):
+    """Process all paths once and return a dict of results."""
+    conf = Config(Namespace(
+        tag_limit=4, verbose=0, update_cache=False, interactive=False,
+        dry=args.dry, difflib=args.difflib, release=args.release,
+        jobs=args.jobs, plan=False, incremental=False, journal=False))
+    wlg = WhatLastGenre(conf)
+    replay.install(wlg.daprs, adapter)
+    for dapr in wlg.daprs:
+        dapr.rate_limit = args.rate_limit
+    timer = StageTimer(wlg)
+    requests = adapter.requests
+    time_ = time.time()
+    if args.jobs > 1:
+        pipe = pipeline.Pipeline(wlg, args.jobs)
+        with closing(pipe.run(paths)) as jobs:
+            for _ in jobs:
+                pass
+    else:
+        for path in paths:
+            wlg.progress_path(path)
+    seconds = time.time() - time_
+    wlg.save_caches()
+    for handler in list(wlg.log.handlers):
+        wlg.log.removeHandler(handler)
+    stats = defaultdict(float)
+    for dapr in wlg.daprs:
+        stats['requests'] += dapr.stats['reqs_web']
+        stats['queries'] += dapr.get_stats('reqs_total')
+        stats['cached'] += dapr.stats['reqs_cache']
+    return {'albums': len(paths),
+            'seconds': seconds,
+            'albums/s': len(paths) / seconds,
+            'requests': adapter.requests - requests,
+            'requests/album': stats['requests'] / len(paths),
+            'cache hit ratio': (stats['cached'] / stats['queries']
+                                if stats['queries'] else 0.0),
+            'errors': sum(len(v) for k, v in wlg.stats.messages.items()
+                          if k[0] >= logging.ERROR),
+            'stages': {k[:-6]: timer.times[k] for k in STAGES}}
+
+
+def print_results(results):
+    """Print a table of the results of all runs."""
+    print('\n%-16s' % '' + ''.join('%12s' % name for name in results))
+    for key in ['albums', 'seconds', 'albums/s', 'requests',
+                'requests/album', 'cache hit ratio', 'errors']:
+        print('%-16s' % key + ''.join(
+            '%12.2f' % res[key] if isinstance(res[key], float)
+            else '%12d' % res[key] for res in results.values()))
+    for stage in STAGES:
+        stage = stage[:-6]
+        print('%-16s' % ('time ' + stage) + ''.join(
+            '%12.2f' % res['stages'][stage] for res in results.values()))
+
+
+def get_args():
+    """Get the cmdline arguments from ArgumentParser."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark whatlastgenre on generated albums '
+                    'with replayed API responses.')
+    parser.add_argument('-a', '--albums', metavar='N', type=int, default=50,
+                        help='number of albums to generate')
+    parser.add_argument('-t', '--tracks', metavar='N', type=int, default=4,
+                        help='number of tracks per album')
+    parser.add_argument('--artists', metavar='N', type=int,
+                        help='number of different artists '
+                             '(default: a third of the albums)')
+    parser.add_argument('-s', '--sources',
+                        default='discogs, lastfm, mbrainz, redacted',
+                        help='sources to query')
+    parser.add_argument('-l', '--latency', metavar='SEC', type=float,
+                        default=.05, help='simulated response time')
+    parser.add_argument('--rate-limit', metavar='SEC', type=float,
+                        default=0.0, help='rate limit of all sources')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='albums to process concurrently')
+    parser.add_argument('-n', '--dry', action='store_true',
+                        help='don\'t save metadata')
+    parser.add_argument('-d', '--difflib', action='store_true',
+                        help='enable fuzzy matching of tags')
+    parser.add_argument('-r', '--release', action='store_true',
+                        help='get release info from redacted')
+    parser.add_argument('--fixtures', metavar='DIR', default=replay.FIXTURES,
+                        help='directory of the recorded responses')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results as json to FILE')
+    return parser.parse_args()
+
+
+def main():
+    """Generate albums, run the benchmark twice and report."""
+    args = get_args()
+    workdir = tempfile.mkdtemp(prefix='wlg_bench_')
+    # config, caches and state of whatlastgenre go to ~/.whatlastgenre
+    os.environ['HOME'] = workdir
+    try:
+        write_config(workdir, args.sources)
+        print("Generating %d albums... " % args.albums, end='')
+        sys.stdout.flush()
+        paths = albums.make_albums(os.path.join(workdir, 'music'),
+                                   args.albums, args.tracks, args.artists)
+        print("done!")
+        adapter = replay.ReplayAdapter(replay.load_fixtures(args.fixtures),
+                                       args.latency)
+        results = {}
+        for name in ['cold', 'warm']:
+            print("Running %s cache benchmark... " % name, end='')
+            sys.stdout.flush()
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                results[name] = run(args, paths, adapter)
+            print("done! (%.2f s)" % results[name]['seconds'])
+        print_results(results)
+        if args.json:
+            with open(args.json, 'w') as file_:
+                json.dump(results, file_, indent=2, sort_keys=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,7 +25,7 @@ from beets import config
 from beets.plugins import BeetsPlugin
 from beets.ui import Subcommand, decargs
 from beetsplug.lastgenre import WHITELIST as BEET_LG_WHITELIST
-from wlg import whatlastgenre
+from wlg import profiling, whatlastgenre
 from wlg.mediafile import Metadata
 
 
@@ -59,7 +59,11 @@ class WhatLastGenre(BeetsPlugin):
             verbose=verbose,
             dry=False,
             difflib=False,
-            release=False))
+            release=False,
+            jobs=1,
+            plan=False,
+            incremental=False,
+            journal=False))
         conf.set('wlg', 'whitelist', str(whitelist))
         self.wlg = whatlastgenre.WhatLastGenre(conf)
 
@@ -67,7 +71,7 @@ class WhatLastGenre(BeetsPlugin):
         """Since __del__s don't get called we need to do some stuff
         manually.
         """
-        self.wlg.cache.save()
+        self.wlg.save_caches()
 
     def commands(self):
         cmds = Subcommand('wlg', help='get genres with whatlastgenre')
@@ -80,6 +84,9 @@ class WhatLastGenre(BeetsPlugin):
         cmds.parser.add_option(
             '-u', '--update-cache', dest='cache', action='store_true',
             default=False, help='force update cache')
+        cmds.parser.add_option(
+            '--profile', dest='profile', metavar='FILE',
+            help='profile the run and write the profile to FILE')
         cmds.func = self.commanded
         return [cmds]
 
@@ -92,6 +99,10 @@ class WhatLastGenre(BeetsPlugin):
             self.config['force'] = True
 
         albums = lib.albums(decargs(args))
+        profiler = None
+        if opts.profile:
+            profiler = profiling.factory(opts.profile)
+            profiler.start()
         i = 1
         try:
             for i, album in enumerate(albums, start=1):
@@ -108,7 +119,12 @@ class WhatLastGenre(BeetsPlugin):
         except KeyboardInterrupt:
             pass
 
+        if profiler:
+            profiler.stop()
+            profiler.save(opts.profile)
         self.wlg.print_stats(i)
+        if profiler:
+            self._log.info(profiling.report(profiler.functions()))
         self.setdown()
 
     def imported(self, _, task):
@@ -47,6 +47,7 @@ setup(
     install_requires=['mutagen', 'requests'],
     tests_requires=['pytest'],
     extras_require={
+        'async': ['aiohttp'],
         'discogs': ['rauth'],
         'reqcache': ['requests-cache'],
     },
@@ -30,7 +30,11 @@ def get_config():
         interactive=False,
         dry=False,
         difflib=False,
-        release=False)
+        release=False,
+        jobs=1,
+        plan=False,
+        incremental=False,
+        journal=False)
     try:
         conf = Config(args)
     except SystemExit:
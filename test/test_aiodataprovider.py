@@ -0,0 +1,110 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""aiodataprovider tests
+
+These tests run against a local aiohttp server instead of the remote
+APIs.
+"""
+
+
+
+import asyncio
+import unittest
+
+import pytest
+
+from wlg import aiodataprovider, dataprovider
+
+web = pytest.importorskip('aiohttp.web')
+test_utils = pytest.importorskip('aiohttp.test_utils')
+
+
+async def toptags(request):
+    """Return the params of a request as Last.FM toptags."""
+    if request.query.get('artist') == 'error':
+        return web.Response(status=500)
+    tags = [{'name': k, 'count': 1} for k in request.query]
+    return web.json_response({'toptags': {'tag': tags}})
+
+
+class LocalLastFM(aiodataprovider.LastFM):
+    """Last.FM DataProvider sending its requests to a local server."""
+    url = None
+
+    async def _arequest(self, url, params, method='GET'):
+        return await super(LocalLastFM, self)._arequest(
+            self.url, params, method)
+
+
+class TestAsyncDataProvider(unittest.TestCase):
+
+    def run_server(self, coro_func):
+        """Run coro_func with a dapr using a local server."""
+
+        async def run():
+            app = web.Application()
+            app.router.add_get('/', toptags)
+            server = test_utils.TestServer(app)
+            await server.start_server()
+            dapr = LocalLastFM()
+            dapr.url = str(server.make_url('/'))
+            dapr.rate_limit = 0
+            try:
+                return await coro_func(dapr)
+            finally:
+                await dapr.aclose()
+                await server.close()
+
+        return asyncio.run(run())
+
+    def test_query_artist(self):
+        res = self.run_server(lambda d: d.aquery_artist('nirvana'))
+        self.assertEqual(set(res[0]['tags']),
+                         {'method', 'artist', 'format', 'api_key'})
+
+    def test_concurrent_queries(self):
+
+        async def query(dapr):
+            return await asyncio.gather(
+                *[dapr.aquery_artist('a%d' % i) for i in range(20)])
+
+        res = self.run_server(query)
+        self.assertEqual(len(res), 20)
+
+    def test_params(self):
+
+        async def query(dapr):
+            return await dapr._arequest_json(
+                dapr.url, {'none': None, 'bool': True, 'int': 1})
+
+        res = self.run_server(query)
+        self.assertEqual({t['name'] for t in res['toptags']['tag']},
+                         {'bool', 'int'})
+
+    def test_bad_status(self):
+        with self.assertRaises(dataprovider.DataProviderError):
+            self.run_server(lambda d: d.aquery_artist('error'))
+
+    def test_sync_transport_without_loop(self):
+
+        class FakeLastFM(dataprovider.LastFM):
+            def _request_json(self, url, params, method='GET'):
+                return {'toptags': {'tag': {'name': params['artist']}}}
+
+        res = FakeLastFM().query_artist('nirvana')
+        self.assertEqual(res, [{'tags': {'nirvana': 0}}])
@@ -19,15 +19,22 @@
 
 
 
+import json
 import os
 import shutil
+import sqlite3
 import tempfile
+import threading
 import time
 import unittest
 
-from wlg.cache import Cache
+from wlg.cache import Cache, CacheError, SingleFlight, SqliteCache, \
+    TagCache, factory
 
 CACHE_PATH = os.path.join(tempfile.gettempdir(), 'wlg_test_cache')
+SQLITE_CACHE_PATH = os.path.join(tempfile.gettempdir(),
+                                 'wlg_test_sqlite_cache')
+TAG_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'wlg_test_tag_cache')
 
 
 class TestCache(unittest.TestCase):
@@ -55,8 +62,8 @@ class TestCache(unittest.TestCase):
     def test_clean(self):
         key = 'testclean' + str(time.time())
         self.cache.set(key, [])
-        newtime = self.cache.cache[key][0] - self.cache.expire_after - 1
-        self.cache.cache[key] = (newtime, [])
+        newtime = self.cache.get(key)[0] - self.cache.expire_after - 1
+        self.cache.cache[key] = self.cache._pack(newtime, [])[0]
         size = len(self.cache.cache)
         self.cache.clean()
         self.assertEqual(size - 1, len(self.cache.cache))
@@ -65,3 +72,237 @@ class TestCache(unittest.TestCase):
         self.assertFalse(os.path.exists(self.cache.fullpath))
         self.cache.save()
         self.assertTrue(os.path.exists(self.cache.fullpath))
+
+    def test_compact(self):
+        key = ('lastfm', 'artist', 'compact' + str(time.time()))
+        val = [{'tags': {'rock': 100, 'jazz': 0.5, 'pop': 0}},
+               {'tags': {'rock': 3}, 'releasetype': 'Album', 'date': '1999'},
+               {'tags': None},
+               {'info': 'no tags'}]
+        self.cache.set(key, val)
+        self.assertEqual(self.cache.get(key)[1], val)
+        self.assertIsInstance(self.cache.cache[key], bytes)
+        # 12 bytes header and 4 per result, 8 per packed tag
+        self.assertEqual(len(self.cache.cache[key]), 12 + 4 * 4 + 8 * 4)
+        # tag names are stored once
+        self.assertEqual(self.cache.vocab.count('rock'), 1)
+        self.cache.set(key, None)
+        self.assertIsNone(self.cache.get(key)[1])
+        self.assertNotIn(key, self.cache.other)
+
+    def test_load_saved(self):
+        path = os.path.join(CACHE_PATH, 'load')
+        os.mkdir(path)
+        keys = [('lastfm', 'album', 'artistalbum'),
+                ('redacted', 'album', "it's\\"), 'plain']
+        val = [{'tags': {'rock': 2, 'pop': 1, 'jazz': 0.3, 'funk': 1 / 3},
+                'releasetype': 'EP'}]
+        with open(os.path.join(path, 'cache'), 'w') as file_:
+            json.dump({str(k): (time.time(), val) for k in keys}, file_)
+        cache = Cache(path, False)
+        for key in keys:
+            self.assertIn(key, cache.cache)
+            self.assertEqual(cache.get(key)[1][0]['tags']['jazz'], 0.3)
+            self.assertAlmostEqual(cache.get(key)[1][0]['tags']['funk'], 1 / 3)
+        saved = []
+        for _ in range(2):
+            cache.dirty = True
+            cache.save()
+            with open(os.path.join(path, 'cache')) as file_:
+                saved.append(file_.read())
+            cache = Cache(path, False)
+        # saving again doesn't change anything
+        self.assertEqual(saved[0], saved[1])
+        data = json.loads(saved[0])
+        self.assertEqual(sorted(data), sorted(str(k) for k in keys))
+        self.assertEqual(data[str(keys[0])][1][0]['tags']['jazz'], 0.3)
+
+
+class TestSqliteCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not os.path.exists(SQLITE_CACHE_PATH):
+            os.mkdir(SQLITE_CACHE_PATH)
+        cls.cache = SqliteCache(SQLITE_CACHE_PATH, True)
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(SQLITE_CACHE_PATH):
+            shutil.rmtree(SQLITE_CACHE_PATH)
+
+    def test_get_and_set(self):
+        key = 'test' + str(time.time())
+        val = [{'tags': {'test': 0}}]
+        self.cache.set(key, val)
+        self.assertEqual(self.cache.get(key)[1], val)
+
+    def test_get_unknown_key(self):
+        key = 'unknown' + str(time.time())
+        self.assertIsNone(self.cache.get(key))
+
+    def test_clean(self):
+        key = 'testclean' + str(time.time())
+        self.cache.set(key, [])
+        self.cache.conn.execute(
+            'UPDATE cache SET time = time - ? WHERE key = ?',
+            (self.cache.expire_after + 1, key))
+        self.cache.clean()
+        self.cache.update_cache = False
+        self.assertIsNone(self.cache.get(key))
+        self.cache.update_cache = True
+
+    def test_save(self):
+        key = 'testsave' + str(time.time())
+        self.cache.set(key, [])
+        self.cache.save()
+        self.assertFalse(self.cache.dirty)
+        self.assertTrue(os.path.exists(self.cache.fullpath))
+
+    def test_concurrent(self):
+        other = SqliteCache(SQLITE_CACHE_PATH, False)
+        try:
+            key = 'testconcurrent' + str(time.time())
+            self.cache.set(key, [])
+            other.set(key, [{'tags': {'test': 2}}])
+            self.assertEqual(other.get(key)[1], [{'tags': {'test': 2}}])
+            self.cache.update_cache = False
+            self.assertEqual(self.cache.get(key)[1], [{'tags': {'test': 2}}])
+            self.cache.update_cache = True
+        finally:
+            other.save()
+
+    def test_locked(self):
+        other = sqlite3.connect(self.cache.fullpath)
+        other.execute('BEGIN IMMEDIATE')
+        timeout = self.cache.timeout
+        self.cache.conn.execute('PRAGMA busy_timeout = 0')
+        try:
+            key = 'testlocked' + str(time.time())
+            self.cache.set(key, [])
+            self.assertNotIn(key, self.cache.new)
+        finally:
+            other.rollback()
+            other.close()
+            self.cache.conn.execute('PRAGMA busy_timeout = %d'
+                                    % (timeout * 1000))
+
+    def test_migrate(self):
+        path = os.path.join(SQLITE_CACHE_PATH, 'cache')
+        key = str(('lastfm', 'artist', 'migrated'))
+        val = [{'tags': {'test': 1}}]
+        with open(path, 'w') as file_:
+            json.dump({key: (time.time(), val)}, file_)
+        self.cache.migrate(path)
+        self.assertFalse(os.path.exists(path))
+        self.cache.update_cache = False
+        self.assertEqual(self.cache.get(key)[1], val)
+        self.cache.update_cache = True
+
+    def test_migrate_malformed(self):
+        path = os.path.join(SQLITE_CACHE_PATH, 'cache')
+        key = str(('lastfm', 'artist', 'malformed'))
+        val = [{'tags': {'test': 1}}]
+        with open(path, 'w') as file_:
+            json.dump({key: [time.time(), val], 'short': [time.time()],
+                       'none': None, 'time': ['now', val]}, file_)
+        self.cache.migrate(path)
+        self.assertFalse(os.path.exists(path))
+        self.cache.update_cache = False
+        self.assertEqual(self.cache.get(key)[1], val)
+        for key in ['short', 'none', 'time']:
+            self.assertIsNone(self.cache.get(key))
+        self.cache.update_cache = True
+
+
+class TestCacheFactory(unittest.TestCase):
+    def test_unknown_backend(self):
+        with self.assertRaises(CacheError):
+            factory(CACHE_PATH, False, 'unknown')
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def slow(self, result=None, error=None):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if error:
+            raise error
+        return result
+
+    def run_merged(self, func, num=4):
+        results = []
+
+        def follow():
+            try:
+                results.append(self.flight.do('key', func))
+            except ValueError as err:
+                results.append(err)
+
+        leader = threading.Thread(target=follow)
+        leader.start()
+        self.started.wait(5)
+        threads = [threading.Thread(target=follow) for _ in range(num - 1)]
+        for thread in threads:
+            thread.start()
+        # give the followers time to wait for the leader
+        time.sleep(.1)
+        self.release.set()
+        for thread in [leader] + threads:
+            thread.join()
+        return results
+
+    def test_merge(self):
+        results = self.run_merged(lambda: self.slow(result=1))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sorted(results), [(1, False)] + [(1, True)] * 3)
+        self.assertFalse(self.flight.calls)
+
+    def test_error(self):
+        results = self.run_merged(lambda: self.slow(error=ValueError()))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    def test_sequential(self):
+        self.release.set()
+        self.assertEqual(self.flight.do('key', lambda: self.slow(1)),
+                         (1, False))
+        self.assertEqual(self.flight.do('key', lambda: self.slow(2)),
+                         (2, False))
+        self.assertEqual(self.calls, 2)
+
+
+class TestTagCache(unittest.TestCase):
+    def setUp(self):
+        os.mkdir(TAG_CACHE_PATH)
+
+    def tearDown(self):
+        shutil.rmtree(TAG_CACHE_PATH)
+
+    def test_get_and_set(self):
+        cache = TagCache(TAG_CACHE_PATH, 'v1')
+        self.assertIsNone(cache.get('resolve', 'hip hop'))
+        cache.set('resolve', 'hip hop', 'hip-hop')
+        self.assertEqual(cache.get('resolve', 'hip hop'), 'hip-hop')
+
+    def test_save(self):
+        cache = TagCache(TAG_CACHE_PATH, 'v1')
+        cache.set('split', 'pop/rock', [['pop', 'rock'], False, False])
+        cache.save()
+        self.assertFalse(cache.dirty)
+        cache = TagCache(TAG_CACHE_PATH, 'v1')
+        self.assertEqual(cache.get('split', 'pop/rock'),
+                         [['pop', 'rock'], False, False])
+
+    def test_version_changed(self):
+        cache = TagCache(TAG_CACHE_PATH, 'v1')
+        cache.set('resolve', 'hip hop', 'hip-hop')
+        cache.save()
+        cache = TagCache(TAG_CACHE_PATH, 'v2')
+        self.assertIsNone(cache.get('resolve', 'hip hop'))
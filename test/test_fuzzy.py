@@ -0,0 +1,52 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""fuzzy tests"""
+
+
+
+import unittest
+from difflib import get_close_matches
+
+from wlg.fuzzy import FuzzyIndex
+
+WORDS = ['alternative rock', 'drum and bass', 'electronic', 'electronica',
+         'hip-hop', 'industrial', 'progressive rock', 'psychedelic',
+         'rock', 'pop', 'trip-hop']
+
+
+class TestFuzzyIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = FuzzyIndex(WORDS)
+
+    def test_matches(self):
+        self.assertEqual(self.index.matches('progresive rock'),
+                         ['progressive rock'])
+        self.assertEqual(self.index.matches('alternativ rock'),
+                         ['alternative rock'])
+        self.assertEqual(self.index.matches('electronik'), [])
+        self.assertEqual(self.index.matches('shit'), [])
+
+    def test_same_as_difflib(self):
+        keys = ['electronic', 'electronicaa', 'electrnic', 'progresive rock',
+                'drum n bass', 'drum & bass', 'alternativ rock', 'hiphop',
+                'trip hop', 'rok', 'pop', '', 'industrail', 'indutsrial']
+        for key in keys:
+            for cutoff in [.6, .8, .92]:
+                index = FuzzyIndex(WORDS, cutoff)
+                self.assertEqual(index.matches(key, 3),
+                                 get_close_matches(key, WORDS, 3, cutoff))
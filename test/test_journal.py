@@ -0,0 +1,73 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""journal tests"""
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from wlg.journal import Journal
+
+JOURNAL_PATH = os.path.join(tempfile.gettempdir(), 'wlg_test_journal')
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        os.mkdir(JOURNAL_PATH)
+        self.journal = Journal(JOURNAL_PATH)
+
+    def tearDown(self):
+        shutil.rmtree(JOURNAL_PATH)
+
+    def test_empty(self):
+        self.assertEqual(self.journal.pending(), {})
+
+    def test_add(self):
+        self.journal.add('/a', [('genre', ['Rock', 'Pop'])])
+        self.journal.add('/b', [('genre', ['Jazz']), ('date', '2015')])
+        self.assertEqual(self.journal.pending(),
+                         {'/a': [['genre', ['Rock', 'Pop']]],
+                          '/b': [['genre', ['Jazz']], ['date', '2015']]})
+
+    def test_last_change_wins(self):
+        self.journal.add('/a', [('genre', ['Rock'])])
+        self.journal.add('/a', [('genre', ['Pop'])])
+        self.assertEqual(self.journal.pending(), {'/a': [['genre', ['Pop']]]})
+
+    def test_done(self):
+        self.journal.add('/a', [('genre', ['Rock'])])
+        self.journal.add('/b', [('genre', ['Pop'])])
+        self.journal.done('/a')
+        self.assertEqual(list(self.journal.pending()), ['/b'])
+
+    def test_interrupted_write(self):
+        self.journal.add('/a', [('genre', ['Rock'])])
+        with open(self.journal.fullpath, 'a') as file_:
+            file_.write('{"path":"/b","se')
+        self.journal = Journal(JOURNAL_PATH)
+        self.journal.add('/c', [('genre', ['Pop'])])
+        self.assertEqual(sorted(self.journal.pending()), ['/a', '/c'])
+
+    def test_clear(self):
+        self.journal.add('/a', [('genre', ['Rock'])])
+        self.journal.clear()
+        self.assertFalse(os.path.exists(self.journal.fullpath))
+        self.assertEqual(self.journal.pending(), {})
@@ -25,7 +25,8 @@ import tempfile
 import time
 import unittest
 
-from wlg.mediafile import Album, find_music_dirs, VA_MBID
+from wlg.mediafile import Album, MusicDirScanner, Track, find_music_dirs, \
+    iter_music_dirs, VA_MBID
 
 DATA_PATH = os.path.abspath(os.path.join('test', 'data'))
 
@@ -57,6 +58,37 @@ class TestMediafile(unittest.TestCase):
         paths = find_music_dirs([self.temp_path])
         self.assertIn(self.temp_path, paths)
 
+    def test_music_dir_scanner(self):
+        scanner = MusicDirScanner([self.temp_path])
+        self.assertEqual(list(scanner), [self.temp_path])
+        self.assertTrue(scanner.done)
+        self.assertEqual(scanner.found, 1)
+
+    def test_iter_music_dirs(self):
+        root = tempfile.mkdtemp()
+        try:
+            for path in ['a', 'a/b', 'a/c', 'd', 'e/skip']:
+                os.makedirs(os.path.join(root, path))
+            for path in ['a/1.mp3', 'a/b/2.FLAC', 'a/c/3.txt', 'e/skip/4.ogg']:
+                open(os.path.join(root, path), 'w').close()
+            os.symlink(root, os.path.join(root, 'a', 'loop'))
+            os.symlink(os.path.join(root, 'a', 'b'),
+                       os.path.join(root, 'd', 'b'))
+
+            def scan(**kwargs):
+                return sorted(os.path.relpath(p, root) for p in
+                              iter_music_dirs([root], **kwargs))
+
+            self.assertEqual(scan(), ['a', 'a/b', 'e/skip'])
+            self.assertEqual(scan(exclude=['skip']), ['a', 'a/b'])
+            self.assertEqual(scan(exclude=['*/e/*']), ['a', 'a/b'])
+            # every directory only once even with links and loops
+            res = scan(followlinks=True)
+            self.assertEqual(len(res), 3)
+            self.assertIn('e/skip', res)
+        finally:
+            shutil.rmtree(root)
+
     def test_album_get_metadata(self):
         album = self.get_album()
 
@@ -124,6 +156,25 @@ class TestMediafile(unittest.TestCase):
         track.set_meta('album', val)
         self.assertEqual(track.get_meta('album'), val)
 
+    def test_track_meta_memo(self):
+        track = self.get_track()
+        album = track.get_meta('album')
+        track.tags = {}
+        self.assertIs(track.get_meta('album'), album)
+        track.tags = track.muta
+        track.set_meta('album', 'memo test')
+        self.assertEqual(track.get_meta('album'), ['memo test'])
+
+    def test_track_lazy_mutagen(self):
+        for track in self.get_album().tracks:
+            self.assertIsNone(track._muta)
+            track.set_meta('album', track.get_meta('album'))
+            self.assertIsNone(track._muta)
+            self.assertFalse(track.save())
+            track.set_meta('album', 'lazy %s' % time.time())
+            self.assertIsNotNone(track._muta)
+            self.assertTrue(track.dirty)
+
     def test_get_and_set_csv_tags(self):
         album = self.get_album()
         values = ['Artist A', 'Artist B', 'Artist C']
@@ -154,9 +205,35 @@ class TestMediafile(unittest.TestCase):
         track.save()
         self.assertEqual(track.get_meta('genre'), genre)
         track.v23sep = ';'
-        track.set_meta('genre', genre)
+        track.set_meta('genre', genre[:2])
+        date = track.get_meta('date')
         track.save()
-        self.assertEqual(track.get_meta('genre'), genre)
+        track.meta.clear()  # check the tags, not the remembered values
+        self.assertEqual(track.get_meta('genre'), genre[:2])
+        self.assertEqual(track.get_meta('date'), date)
+        with open(track.fullpath, 'rb') as file_:
+            self.assertEqual(file_.read(4), b'ID3\x03')
+        self.assertEqual(Track(os.path.dirname(track.fullpath),
+                               track.filename, ';').get_meta('genre'),
+                         genre[:2])
+
+    def test_save_keeps_padding(self):
+        for track in self.get_album().tracks:
+            track.set_meta('genre', 'Pad')
+            track.save()
+            size = os.path.getsize(track.fullpath)
+            track.set_meta('genre', 'Padding')
+            track.save()
+            self.assertEqual(os.path.getsize(track.fullpath), size)
 
     def test_album_save(self):
         self.get_album().save()
+
+    def test_album_threaded(self):
+        tracks = [t.filename for t in self.get_album().tracks]
+        album = Album(self.temp_path, workers=4)
+        self.assertEqual([t.filename for t in album.tracks], tracks)
+        val = 'test %s' % time.time()
+        album.set_meta('album', val)
+        album.save()
+        self.assertEqual(Album(self.temp_path).get_meta('album'), val)
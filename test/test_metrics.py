@@ -0,0 +1,93 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""metrics tests"""
+
+
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from wlg.metrics import Metrics, STAGES, quantile, to_json, to_prometheus, \
+    write
+
+
+class TestMetrics(unittest.TestCase):
+    def test_quantile(self):
+        values = list(range(1, 101))
+        self.assertEqual(quantile(values, .5), 50)
+        self.assertEqual(quantile(values, .95), 95)
+        self.assertEqual(quantile(values, .99), 99)
+        self.assertEqual(quantile([3], .99), 3)
+        self.assertEqual(quantile([], .5), 0.0)
+
+    def test_summary(self):
+        metrics = Metrics()
+        for i in range(1, 101):
+            metrics.observe('load', i / 100)
+        with metrics.timer('save'):
+            pass
+        summary = metrics.summary()
+        self.assertEqual(list(summary)[:len(STAGES)], list(STAGES))
+        self.assertEqual(summary['load']['count'], 100)
+        self.assertAlmostEqual(summary['load']['sum'], 50.5)
+        self.assertEqual(summary['load']['p50'], .5)
+        self.assertEqual(summary['load']['p95'], .95)
+        self.assertEqual(summary['load']['max'], 1.0)
+        self.assertEqual(summary['save']['count'], 1)
+        self.assertEqual(summary['http']['count'], 0)
+
+    def test_threads(self):
+        metrics = Metrics()
+
+        def observe():
+            for _ in range(1000):
+                metrics.observe('http', .1)
+
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.summary()['http']['count'], 4000)
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.observe('http', .25)
+        report = {'albums': 1, 'version': '0.2',
+                  'sources': {'lastfm': {'reqs_web': 2.0}},
+                  'stages': metrics.summary()}
+        text = to_prometheus(report)
+        self.assertIn('wlg_stage_seconds{stage="http",quantile="0.5"} 0.25',
+                      text)
+        self.assertIn('wlg_stage_seconds_count{stage="http"} 1', text)
+        self.assertIn('wlg_source_reqs_web{source="lastfm"} 2.0', text)
+        self.assertIn('wlg_albums 1.0', text)
+        self.assertNotIn('version', text)
+
+    def test_write(self):
+        report = {'albums': 1, 'stages': Metrics().summary()}
+        path = os.path.join(tempfile.gettempdir(), 'wlg_test_metrics.json')
+        try:
+            write(path, to_json(report))
+            with open(path) as file_:
+                self.assertEqual(json.load(file_), report)
+        finally:
+            os.remove(path)
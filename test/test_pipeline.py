@@ -0,0 +1,84 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""pipeline tests"""
+
+
+
+import logging
+import random
+import time
+import unittest
+
+from wlg.metrics import Metrics
+from wlg.pipeline import Pipeline
+
+
+class FakeAlbum(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_metadata(self):
+        return self.path
+
+
+class FakeWhatLastGenre(object):
+    def __init__(self):
+        self.log = logging.getLogger('wlg.test.pipeline')
+        self.metrics = Metrics()
+        self.saved = []
+
+    def load_album(self, path):
+        time.sleep(random.random() / 100)
+        if path == 'error':
+            raise ValueError(path)
+        print('load %s' % path)
+        return FakeAlbum(path) if path != 'missing' else None
+
+    def query_album(self, metadata, _):
+        time.sleep(random.random() / 100)
+        print('query %s' % metadata)
+        return [metadata.upper()], None
+
+    def save_album(self, album, genres, _):
+        print('save %s %s' % (album.path, genres[0]))
+        self.saved.append(album.path)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run_in_order(self):
+        wlg = FakeWhatLastGenre()
+        paths = ['path%02d' % i for i in range(20)]
+        jobs = list(Pipeline(wlg, 4).run(paths))
+        self.assertEqual([j.path for j in jobs], paths)
+        for job in jobs:
+            self.assertEqual(job.output.getvalue(),
+                             'load %s\nquery %s\nsave %s %s\n'
+                             % (job.path, job.path, job.path,
+                                job.path.upper()))
+        self.assertEqual(sorted(wlg.saved), paths)
+
+    def test_run_album_not_loaded(self):
+        wlg = FakeWhatLastGenre()
+        jobs = list(Pipeline(wlg, 2).run(['missing', 'path']))
+        self.assertIsNone(jobs[0].album)
+        self.assertEqual(wlg.saved, ['path'])
+
+    def test_run_reraises_errors(self):
+        wlg = FakeWhatLastGenre()
+        with self.assertRaises(ValueError):
+            list(Pipeline(wlg, 2).run(['path', 'error', 'path2']))
@@ -0,0 +1,142 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""profiling tests"""
+
+
+
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from wlg import profiling
+from wlg.profiling import Profiler, SamplingProfiler, subsystem, \
+    taglib_range
+
+
+def busy(seconds):
+    """Keep a thread busy for some seconds."""
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def run_threads(profiler):
+    profiler.start()
+    try:
+        threads = [threading.Thread(target=busy, args=(.1,))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        profiler.stop()
+
+
+class TestProfiling(unittest.TestCase):
+    def test_factory(self):
+        self.assertIsInstance(profiling.factory('wlg.folded'),
+                              SamplingProfiler)
+        self.assertIsInstance(profiling.factory('wlg.prof'),
+                              Profiler if profiling.PER_THREAD
+                              else SamplingProfiler)
+
+    def test_subsystem(self):
+        taglib = taglib_range()
+        self.assertEqual(subsystem((taglib[0], taglib[1] + 1, 'resolve'),
+                                   taglib), 'taglib')
+        self.assertEqual(subsystem((taglib[0], 1, 'main'), taglib), 'other')
+        self.assertEqual(subsystem(
+            ('/usr/lib/python3/site-packages/mutagen/id3/_file.py', 1,
+             'save')), 'mediafile')
+        self.assertEqual(subsystem(
+            ('/src/wlg/dataprovider.py', 1, '_request')), 'dataprovider')
+        self.assertEqual(subsystem(
+            ('~', 0, "<method 'search' of 're.Pattern' objects>")),
+            'taglib')
+        self.assertEqual(subsystem(
+            ('~', 0, "<method 'execute' of 'sqlite3.Connection' objects>")),
+            'cache')
+
+    @unittest.skipIf(sys.version_info >= (3, 12), 'needs python < 3.12')
+    def test_profiler(self):
+        profiler = Profiler()
+        run_threads(profiler)
+        functions = profiler.functions()
+        busy_ = [f for f in functions if f[2] == 'busy']
+        self.assertEqual(len(busy_), 1)
+        self.assertGreater(functions[busy_[0]][1], .15)
+        # waiting for the threads isn't reported
+        self.assertFalse(any(profiling.idle(f) for f in functions))
+        self.assertTrue(any(profiling.idle(f)
+                            for f in profiler.stats().stats))
+        self.assertIs(threading.Thread.run, profiler.run)
+        path = os.path.join(tempfile.gettempdir(), 'wlg_test_profile')
+        try:
+            profiler.save(path)
+            self.assertTrue(pstats.Stats(path).stats)
+        finally:
+            os.remove(path)
+
+    def test_sampling_profiler(self):
+        profiler = SamplingProfiler(interval=.001)
+        run_threads(profiler)
+        functions = profiler.functions()
+        self.assertTrue(any(f[2] == 'busy' for f in functions))
+        path = os.path.join(tempfile.gettempdir(), 'wlg_test_profile.folded')
+        try:
+            profiler.save(path)
+            with open(path) as file_:
+                lines = file_.read().splitlines()
+        finally:
+            os.remove(path)
+        self.assertTrue(any('busy (test_profiling.py' in line
+                            for line in lines))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit()
+                            for line in lines))
+        path = os.path.join(tempfile.gettempdir(), 'wlg_test_profile.prof')
+        try:
+            profiler.save(path)
+            stats = pstats.Stats(path).stats
+        finally:
+            os.remove(path)
+        busy_ = [f for f in stats if f[2] == 'busy']
+        self.assertEqual(len(busy_), 1)
+        self.assertTrue(any(c[2] == 'run' for c in stats[busy_[0]][4]))
+
+    def test_idle(self):
+        self.assertTrue(profiling.idle(
+            ('/usr/lib/python3.11/threading.py', 1, 'wait')))
+        self.assertTrue(profiling.idle(
+            ('~', 0, "<method 'acquire' of '_thread.lock' objects>")))
+        self.assertFalse(profiling.idle(
+            ('~', 0, '<built-in method time.sleep>')))
+
+    def test_report(self):
+        taglib = taglib_range()
+        report = profiling.report({
+            (taglib[0], taglib[1], 'resolve'): (2.0, 3.0),
+            ('/src/wlg/cache.py', 1, 'get'): (1.0, 1.0)})
+        lines = report.strip().splitlines()
+        self.assertTrue(lines[1].startswith('taglib'))
+        self.assertIn('66.7%', lines[1])
+        self.assertTrue(lines[3].startswith('cache'))
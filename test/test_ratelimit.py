@@ -0,0 +1,79 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""ratelimit tests"""
+
+
+
+import os
+import tempfile
+import time
+import unittest
+
+from wlg import ratelimit
+
+RATELIMIT_PATH = os.path.join(tempfile.gettempdir(), 'wlg_test_ratelimit')
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_no_interval(self):
+        limiter = ratelimit.RateLimiter(0)
+        for _ in range(10):
+            self.assertEqual(limiter.wait(), 0)
+
+    def test_interval(self):
+        limiter = ratelimit.RateLimiter(.02)
+        self.assertEqual(limiter.wait(), 0)
+        time_ = time.monotonic()
+        limiter.wait()
+        limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - time_, .04)
+
+    def test_burst(self):
+        limiter = ratelimit.RateLimiter(10, 3)
+        now = limiter.clock()
+        readies = [limiter.reserve() - now for _ in range(4)]
+        self.assertEqual([round(r) for r in readies], [0, 0, 0, 10])
+
+    def test_refund(self):
+        limiter = ratelimit.RateLimiter(10)
+        limiter.reserve()
+        limiter.refund()
+        self.assertLess(limiter.reserve() - limiter.clock(), 1)
+
+    def test_factory_unknown_mode(self):
+        with self.assertRaises(ratelimit.RateLimitError):
+            ratelimit.factory('unknown', 1)
+
+
+@unittest.skipIf(not ratelimit.fcntl, 'no file locks')
+class TestSharedRateLimiter(unittest.TestCase):
+    def tearDown(self):
+        if os.path.exists(RATELIMIT_PATH):
+            os.remove(RATELIMIT_PATH)
+
+    def test_shared(self):
+        limiter1 = ratelimit.factory('shared', 10, path=RATELIMIT_PATH)
+        limiter2 = ratelimit.factory('shared', 10, path=RATELIMIT_PATH)
+        now = limiter1.clock()
+        self.assertLess(limiter1.reserve() - now, 1)
+        self.assertGreater(limiter2.reserve() - now, 9)
+        self.assertGreater(limiter1.reserve() - now, 19)
+
+    def test_without_path(self):
+        with self.assertRaises(ratelimit.RateLimitError):
+            ratelimit.factory('shared', 1)
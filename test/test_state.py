@@ -0,0 +1,79 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""state tests"""
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from wlg.state import StateIndex, snapshot
+
+from .test_mediafile import DATA_PATH
+
+STATE_PATH = os.path.join(tempfile.gettempdir(), 'wlg_test_state')
+
+
+class TestStateIndex(unittest.TestCase):
+    def setUp(self):
+        os.mkdir(STATE_PATH)
+        self.album_path = os.path.join(STATE_PATH, 'album')
+        shutil.copytree(DATA_PATH, self.album_path)
+        self.state = StateIndex(STATE_PATH)
+
+    def tearDown(self):
+        self.state.conn.close()
+        shutil.rmtree(STATE_PATH)
+
+    def test_snapshot(self):
+        mtime, files = snapshot(self.album_path)
+        self.assertEqual(mtime, os.stat(self.album_path).st_mtime_ns)
+        self.assertEqual([f[0] for f in files],
+                         sorted(os.listdir(self.album_path)))
+
+    def test_snapshot_vanished(self):
+        self.assertIsNone(snapshot(os.path.join(STATE_PATH, 'vanished')))
+
+    def test_unknown(self):
+        self.assertIsNone(self.state.get(self.album_path))
+        self.assertFalse(self.state.unchanged(self.album_path))
+
+    def test_update(self):
+        self.state.update(self.album_path, ['rock', 'pop'])
+        self.assertTrue(self.state.unchanged(self.album_path))
+        self.assertEqual(self.state.get(self.album_path)[2], ['rock', 'pop'])
+
+    def test_changed_file(self):
+        self.state.update(self.album_path, ['rock'])
+        path = os.path.join(self.album_path, 'silence.mp3')
+        with open(path, 'ab') as file_:
+            file_.write(b'\0')
+        self.assertFalse(self.state.unchanged(self.album_path))
+
+    def test_removed_file(self):
+        self.state.update(self.album_path, ['rock'])
+        os.remove(os.path.join(self.album_path, 'silence.ogg'))
+        self.assertFalse(self.state.unchanged(self.album_path))
+
+    def test_persistence(self):
+        self.state.update(self.album_path, ['rock'])
+        self.state.conn.close()
+        self.state = StateIndex(STATE_PATH)
+        self.assertTrue(self.state.unchanged(self.album_path))
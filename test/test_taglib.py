@@ -19,11 +19,15 @@
 
 
 
+import itertools
 import re
+import tempfile
 import unittest
 from random import randint
 
-from wlg.whatlastgenre import Config, TagLib
+from wlg.cache import TagCache
+from wlg.whatlastgenre import Config, TagLib, has_alternation, \
+    regex_gates
 
 from . import get_config
 
@@ -109,6 +113,17 @@ class TestTagLib(unittest.TestCase):
             self.assertIsNone(key)
             self.assertIsNone(match)
 
+    def test_fuzzy_match_cached(self):
+        tagcache = TagCache(tempfile.gettempdir(), 'test')
+        taglib = TagLib(self.taglib.conf, WHITELIST, TAGSFILE, tagcache)
+        self.assertEqual(taglib.fuzzy_match('progresive'), 'progressive')
+        self.assertIsNone(taglib.fuzzy_match('shit'))
+        self.assertEqual(tagcache.get('fuzzy', 'shit'), '')
+        taglib.fuzzy = None
+        self.assertIsNone(taglib.fuzzy_match('shit'))
+        self.assertIsNone(taglib.fuzzy)
+        tagcache.dirty = False
+
     def test_split(self):
         tags = [
             'pop/country',
@@ -136,6 +151,42 @@ class TestTagLib(unittest.TestCase):
         for tag in tags_split:
             self.assertIn(tag, iter(self.taglib.taggrps['artist'].keys()))
 
+    def test_split_parts(self):
+        keys, flag, splitup = self.taglib.split_parts(
+            'awesome progressive jazz rock from the 90s')
+        self.assertEqual(keys, ['progressive', 'jazz', 'rock'])
+        self.assertTrue(flag)
+        self.assertTrue(splitup)
+
+    def test_split_parts_long(self):
+        tags = dict(TAGSFILE, regex=[
+            (re.compile(r'\btrip ?hop\b', re.I), 'trip-hop'),
+            (re.compile(r'\belectro\b', re.I), 'electronic')])
+        taglib = TagLib(self.taglib.conf,
+                        WHITELIST + ['intelligent dance music'], tags)
+        words = ('some great intelligent dance music with jazz and hip hop '
+                 'trip hop and electro from the old days').split(' ')
+        words = [w for w in words if len(w) > 2]
+        # all combinations that may resolve, like before the pruning
+        expected = []
+        for length in range(1, 4):
+            for combi in itertools.combinations(words, length):
+                combi = ' '.join(combi)
+                if taglib.may_resolve(combi):
+                    expected.append(combi)
+        checked = []
+        may_replace = taglib.may_replace
+        taglib.may_replace = lambda k: checked.append(k) or may_replace(k)
+        keys, _, _ = taglib.split_parts(' '.join(words))
+        self.assertEqual(keys, expected)
+        self.assertIn('intelligent dance music', keys)
+        self.assertIn('trip hop electro', keys)
+        # only words and pairs get checked against the regexes
+        num = len(words)
+        self.assertEqual(len(checked), num + num * (num - 1) // 2)
+        self.assertLess(len(checked), sum(
+            len(list(itertools.combinations(words, i))) for i in range(1, 4)))
+
     def test_merge(self):
         self.taglib.add({'pop': 0.6}, 'artist')
         self.taglib.add({'rock': 0.3}, 'album')
@@ -166,3 +217,50 @@ class TestTagLib(unittest.TestCase):
         self.taglib.conf.args.tag_limit = limit
         self.taglib.add({'rock': 1, 'pop': 1, 'jazz': 1}, 'album')
         self.assertEqual(limit, len(self.taglib.get_genres(False)))
+
+    def test_resolve_regex_gates(self):
+        regexes = [(re.compile(pat, re.I), repl) for pat, repl in [
+            (r'[\'"]+', ''),
+            (r'\btrip ?hop\b', 'triphop'),
+            (r'\btriphop\b', 'trip-hop'),
+            (r'\b(c|k)[ /]*(pop|rock)\b', r'\g<1>-\g<2>'),
+            (r'\bk-pop\b', 'korean pop'),
+            (r'\bfoo|bar\b', 'baz'),
+            (r'  +', ' ')]]
+        keys = ['trip hop', "'trip hop'", 'triphop', 'k pop', 'c rock  k/pop',
+                'pop', 'k-pop', 'hop trip', '', 'foox', 'xbar', 'xfoo']
+        tags = dict(TAGSFILE, regex=regexes)
+        taglib = TagLib(self.taglib.conf, WHITELIST, tags)
+        expected = [taglib.resolve(k) for k in keys]
+        self.assertEqual(expected[:5], ['trip-hop', 'trip-hop', 'trip-hop',
+                                        'korean pop', 'c-rock korean pop'])
+        self.assertEqual(expected[9:], ['bazx', 'xbaz', 'xfoo'])
+        tags['gates'] = regex_gates(regexes)
+        self.assertIsNotNone(tags['gates'])
+        taglib = TagLib(self.taglib.conf, WHITELIST, tags)
+        self.assertEqual([taglib.resolve(k) for k in keys], expected)
+
+    def test_tagcache(self):
+        tagcache = TagCache(tempfile.gettempdir(), 'test')
+        tags = {'drum and bass': 1, 'hip hop': 1, 'pop/rock': 1,
+                'progressive rock jazz': 1, 'blues': 1}
+        results = []
+        for _ in range(2):
+            taglib = TagLib(self.taglib.conf, WHITELIST, TAGSFILE, tagcache)
+            taglib.add(tags, 'artist')
+            results.append(dict(taglib.taggrps['artist']))
+        self.taglib.add(tags, 'artist')
+        self.assertEqual(results[0], dict(self.taglib.taggrps['artist']))
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(tagcache.get('split', 'pop/rock'),
+                         (['pop', 'rock'], False, False))
+        tagcache.dirty = False
+
+    def test_has_alternation(self):
+        self.assertTrue(has_alternation('foo|bar'))
+        self.assertTrue(has_alternation('(a)|[|]'))
+        self.assertFalse(has_alternation('(c|k)[ /]*(pop|rock)'))
+        self.assertFalse(has_alternation(r'[^]|^]\|'))
+
+    def test_regex_gates_backreference(self):
+        self.assertIsNone(regex_gates([(re.compile(r'(a)\1', re.I), 'a')]))
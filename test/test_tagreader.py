@@ -0,0 +1,89 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""tagreader tests"""
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mutagen
+
+from wlg import tagreader
+
+from .test_mediafile import DATA_PATH
+
+
+class TestTagReader(unittest.TestCase):
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path)
+
+    def copy(self, ext):
+        path = os.path.join(self.temp_path, 'silence.' + ext)
+        shutil.copy(os.path.join(DATA_PATH, 'silence.' + ext), path)
+        return path
+
+    def assert_same_tags(self, path, ext):
+        tags = tagreader.read_tags(path, ext)
+        self.assertIsNotNone(tags)
+        muta = mutagen.File(path, easy=True)
+        self.assertEqual(dict(tags), dict(muta.tags or {}))
+
+    def test_same_as_mutagen(self):
+        for ext in ['flac', 'ogg', 'mp3', 'm4a']:
+            self.assert_same_tags(os.path.join(DATA_PATH, 'silence.' + ext),
+                                  ext)
+
+    def test_multiple_values(self):
+        for ext in ['flac', 'ogg', 'mp3', 'm4a']:
+            path = self.copy(ext)
+            muta = mutagen.File(path, easy=True)
+            muta['artist'] = ['Alice', 'Bob']
+            muta['musicbrainz_albumid'] = ['album mbid']
+            muta.save()
+            self.assert_same_tags(path, ext)
+
+    def test_flac_picture(self):
+        path = self.copy('flac')
+        muta = mutagen.File(path)
+        picture = mutagen.flac.Picture()
+        picture.mime = 'image/png'
+        picture.desc = 'cover'
+        picture.data = b'\0' * 1000
+        # put the picture before the vorbis comment block
+        muta.metadata_blocks.insert(1, picture)
+        muta.save()
+        self.assertEqual(mutagen.File(path).metadata_blocks[1].code, 6)
+        self.assert_same_tags(path, 'flac')
+
+    def test_no_tags(self):
+        path = self.copy('mp3')
+        mutagen.File(path).delete()
+        self.assertEqual(tagreader.read_tags(path, 'mp3'), {})
+
+    def test_unreadable(self):
+        path = os.path.join(self.temp_path, 'broken.flac')
+        with open(path, 'wb') as file_:
+            file_.write(b'fLaC\x04\x00')
+        self.assertIsNone(tagreader.read_tags(path, 'flac'))
+        self.assertIsNone(tagreader.read_tags(path, 'wav'))
@@ -28,8 +28,9 @@ from tempfile import NamedTemporaryFile
 
 from .test_mediafile import DATA_PATH
 from wlg import whatlastgenre
-from wlg.dataprovider import DataProvider
-from wlg.mediafile import Metadata
+from wlg.dataprovider import DataProvider, DataProviderError
+from wlg.journal import Journal
+from wlg.mediafile import Album, Metadata
 
 from . import get_config
 
@@ -54,6 +55,20 @@ class TestWhatLastGenreClass(unittest.TestCase):
             with NamedTemporaryFile() as file_:
                 self.wlg.read_whitelist(file_.name)
 
+    def test_stats_report(self):
+        self.assertIs(self.wlg.daprs[0].metrics, self.wlg.metrics)
+        report = self.wlg.stats_report(1)
+        self.assertEqual(report['albums'], 1)
+        self.assertIn('lastfm', report['sources'])
+        self.assertIn('http', report['stages'])
+
+    def test_save_caches(self):
+        self.wlg.tagcache.set('resolve', 'test', 'test')
+        self.wlg.save_caches()
+        self.assertFalse(self.wlg.tagcache.dirty)
+        self.assertFalse(self.wlg.cache.dirty)
+        self.assertTrue(os.path.isfile(self.wlg.tagcache.fullpath))
+
     def test_read_tagsfile(self):
         tagsfile = self.wlg.read_tagsfile()
         self.assertIn('upper', list(tagsfile.keys()))
@@ -79,6 +94,19 @@ class TestWhatLastGenreClass(unittest.TestCase):
         self.wlg.progress_path(os.path.join(tempfile.gettempdir(),
                                             'wlg_test_not_found'))
 
+    def test_flush_journal(self):
+        temp_path = os.path.join(tempfile.gettempdir(), 'wlg_tests')
+        shutil.copytree(DATA_PATH, temp_path)
+        self.wlg.journal = Journal(temp_path)
+        try:
+            self.wlg.journal.add(temp_path, [('genre', ['Journal'])])
+            self.wlg.flush_journal()
+            self.assertEqual(self.wlg.journal.pending(), {})
+            self.assertEqual(Album(temp_path).get_meta('genre'), 'Journal')
+        finally:
+            self.wlg.journal = None
+            shutil.rmtree(temp_path)
+
     def test_query_album(self):
         metadata = Metadata(
             path='/tmp',
@@ -116,6 +144,48 @@ class TestWhatLastGenreClass(unittest.TestCase):
         self.assertTrue(cached)
         del self.wlg.cache.cache[str(self.wlg.cache.cachekey(query))]
 
+    def test_fetch_queries(self):
+        class Slow(DataProvider):
+            def query_artist(self, artist):
+                time.sleep(.01)
+                return [{'tags': {'%s %s' % (self.name, artist): 1}}]
+
+        class Fast(Slow):
+            def query_artist(self, artist):
+                if artist.startswith('error'):
+                    raise DataProviderError(artist)
+                return super(Fast, self).query_artist(artist)
+
+        queries = []
+        for artist in ['%s%s' % (a, time.time()) for a in ['a', 'error', 'b']]:
+            for dapr in [Slow(), Fast()]:
+                queries.append(whatlastgenre.Query(
+                    infohash=None, dapr=dapr, type='artist', str=artist,
+                    score=1, artist=artist, mbid_artist=None, album='',
+                    mbid_album='', mbid_relgrp='', year='', releasetype=''))
+        results = self.wlg.fetch_queries(queries)
+        self.assertEqual(len(results), len(queries))
+        for query, (res, cached, err) in zip(queries, results):
+            self.assertFalse(cached)
+            if query.artist.startswith('error') and query.dapr.name == 'Fast':
+                self.assertIsInstance(err, DataProviderError)
+            else:
+                self.assertIsNone(err)
+                self.assertEqual(list(res[0]['tags']),
+                                 ['%s %s' % (query.dapr.name.lower(),
+                                             query.artist)])
+
+    def test_plan_queries(self):
+        missing = os.path.join(tempfile.gettempdir(), 'wlg_test_not_found')
+        queries, counts = self.wlg.plan_queries(
+            [DATA_PATH, DATA_PATH, missing])
+        self.assertEqual(list(counts), ['LastFM'])
+        count = counts['LastFM']
+        self.assertTrue(count['unique'])
+        self.assertEqual(count['queries'], 2 * count['unique'])
+        self.assertEqual(count['unique'], count['cached'] + count['requests'])
+        self.assertEqual(len(queries), count['requests'])
+
     def test_create_queries_with_albumartist(self):
         metadata = Metadata(
             path='/tmp',
@@ -194,9 +264,20 @@ class TestWhatLastGenre(unittest.TestCase):
             ('Album Vol. 3', 'album 3'),
             ('album - soundtrack', 'album'),
             ('album (limited edition)', 'album'),
+            ('album (live) ', 'album (live)'),
+            ('Artist - Live - Album', 'artist'),
+            ('"Album": Part 1, 2', 'part 1 2'),
+            ('(Album)', '(album)'),
         ]
         for raw, done in test_data:
             self.assertEqual(done, whatlastgenre.searchstr(raw))
+            self.assertEqual(done, whatlastgenre.searchstr(raw))  # cached
+
+    def test_progresscounter(self):
+        self.assertEqual(whatlastgenre.progresscounter(3, 10, False),
+                         '(3/10+) scanning...')
+        self.assertEqual(whatlastgenre.progresscounter(10, 10, True),
+                         '(10/10) scan finished')
 
     def test_tag_display(self):
         res = whatlastgenre.tag_display([('a', 1), ('b', 2), ('c', 3)])
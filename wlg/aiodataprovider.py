@@ -0,0 +1,201 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre aiodataprovider
+
+Contains asynchronous variants of the DataProviders using aiohttp,
+so one event loop can run many queries at once.
+"""
+
+import asyncio
+import copy
+import json
+import time
+
+import requests
+
+from . import dataprovider
+from .dataprovider import HEADERS, DataProviderError
+
+try:  # aiohttp is only needed for the async dataproviders
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# max. open connections per dataprovider
+CONNECTIONS = 8
+# tries of requests failing because of connection errors
+RETRIES = 3
+# seconds until requests time out
+TIMEOUT = 60
+
+
+def factory(name, conf):
+    """Factory for async DataProviders."""
+    if name == 'discogs':
+        dapr = Discogs(conf)
+    elif name == 'lastfm':
+        dapr = LastFM()
+    elif name == 'mbrainz':
+        dapr = MusicBrainz()
+    elif name == 'redacted':
+        dapr = Redacted(conf)
+    else:
+        raise DataProviderError('unknown dataprovider: %s' % name)
+    return dapr
+
+
+class AsyncResponse(object):
+    """Response of an async request with its body already read."""
+
+    def __init__(self, status_code, reason, text):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+    def json(self):
+        """Return the decoded json body."""
+        return json.loads(self.text)
+
+
+class AsyncDataProvider(dataprovider.DataProvider):
+    """Base class for async DataProviders.
+
+    Mixed in before a DataProvider it replaces the blocking transport
+    of the query coroutines with a pooled aiohttp session.  Run the
+    aquery_* coroutines in an event loop and call aclose() when done.
+    The blocking requests.Session is still used to login.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if not aiohttp:
+            raise DataProviderError('async dataproviders need aiohttp')
+        super(AsyncDataProvider, self).__init__(*args, **kwargs)
+        self.asession = None
+
+    def _get_asession(self):
+        """Return the aiohttp session, create it if needed."""
+        if self.asession is None or self.asession.closed:
+            self.asession = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=CONNECTIONS),
+                headers=HEADERS,
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+        return self.asession
+
+    async def aclose(self):
+        """Close the aiohttp session."""
+        if self.asession is not None:
+            await self.asession.close()
+            self.asession = None
+
+    async def _await_rate_limit(self):
+        """Wait for the rate limit without blocking the event loop."""
+        waited = max(0, self.limiter.reserve() - self.limiter.clock())
+        if waited:
+            await asyncio.sleep(waited)
+        self._count_wait(waited)
+
+    def _sign(self, method, url, params):
+        """Return the params to send, signed if the site requires it."""
+        return params
+
+    async def _arequest(self, url, params, method='GET'):
+        """Send a request (coroutine).
+
+        Honor rate limits and record some timings for stats.
+
+        :param url: url string
+        :param params: dict of call parameters
+        :param method: request method
+        """
+        # aiohttp doesn't accept None or bool values like requests
+        params = {k: v if isinstance(v, str) else str(v)
+                  for k, v in (params or {}).items() if v is not None}
+        await self._await_rate_limit()
+        params = self._sign(method, url, params)
+        key = 'data' if method == 'POST' else 'params'
+        time_ = time.time()
+        for try_ in range(RETRIES):
+            try:
+                async with self._get_asession().request(
+                        method, url, cookies=self.session.cookies.get_dict(),
+                        **{key: params}) as res:
+                    res = AsyncResponse(res.status, res.reason,
+                                        await res.text())
+                break
+            except aiohttp.TooManyRedirects as err:
+                raise requests.exceptions.TooManyRedirects(str(err))
+            except aiohttp.ClientConnectionError as err:
+                if try_ < RETRIES - 1:
+                    continue
+                self.log.debug(err)
+                raise DataProviderError("request: %s" % err)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                self.log.debug(err)
+                raise DataProviderError("request: %s" % err)
+        with self.lock:
+            self.stats['reqs_web'] += 1
+            self.stats['time_resp'] += time.time() - time_
+        self._observe('http', time.time() - time_)
+        if res.status_code not in [200, 404]:
+            raise DataProviderError(
+                'status code %d: %s' % (res.status_code, res.reason))
+        return res
+
+    async def _arequest_json(self, url, params, method='GET'):
+        """Return a json response from a request (coroutine)."""
+        res = await self._arequest(url, params, method=method)
+        time_ = time.time()
+        try:
+            result = res.json()
+        except ValueError as err:
+            self.log.debug(res.text)
+            raise DataProviderError("json request: %s" % err)
+        self._observe('decode', time.time() - time_)
+        return result
+
+
+class Discogs(AsyncDataProvider, dataprovider.Discogs):
+    """Async Discogs DataProvider"""
+
+    def _sign(self, method, url, params):
+        """Return params with the OAuth parameters and signature."""
+        # pylint: disable=protected-access
+        req_kwargs = {'data' if method == 'POST' else 'params':
+                      copy.deepcopy(params)}
+        oauth_params = self.session._get_oauth_params(req_kwargs)
+        oauth_params['oauth_signature'] = self.session.signature.sign(
+            self.session.consumer_secret, self.session.access_token_secret,
+            method, url, oauth_params, req_kwargs)
+        params = dict(params)
+        params.update((k, str(v)) for k, v in oauth_params.items())
+        return params
+
+
+class LastFM(AsyncDataProvider, dataprovider.LastFM):
+    """Async Last.FM DataProvider"""
+    pass
+
+
+class MusicBrainz(AsyncDataProvider, dataprovider.MusicBrainz):
+    """Async MusicBrainz DataProvider"""
+    pass
+
+
+class Redacted(AsyncDataProvider, dataprovider.Redacted):
+    """Async Redacted.ch DataProvider"""
+    pass
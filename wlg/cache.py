@@ -19,31 +19,47 @@
 
 
 
+import ast
 import json
 import os
+import sqlite3
+import struct
+import sys
+import threading
 import time
+from concurrent.futures import Future
 from datetime import timedelta
 from tempfile import NamedTemporaryFile
 
 
-class Cache(object):
-    """Load/save a dict as json from/to a file."""
+def factory(path, update_cache, backend='sqlite'):
+    """Factory for Caches."""
+    if backend == 'json':
+        cache = Cache(path, update_cache)
+    elif backend == 'sqlite':
+        cache = SqliteCache(path, update_cache)
+    else:
+        raise CacheError('unknown cache backend: %s' % backend)
+    return cache
 
-    def __init__(self, path, update_cache):
-        self.fullpath = os.path.join(path, 'cache')
+
+class CacheError(Exception):
+    """If something went wrong with the Cache."""
+    pass
+
+
+class BaseCache(object):
+    """Base class for Caches."""
+
+    def __init__(self, update_cache):
         self.update_cache = update_cache
         self.expire_after = timedelta(days=180).total_seconds()
         self.time = time.time()
         self.dirty = False
-        self.cache = {}
+        self.lock = threading.RLock()
         # this new set is to avoid doing the same query multiple
         # times during the same run while using update_cache
         self.new = set()
-        try:
-            with open(self.fullpath) as file_:
-                self.cache = json.load(file_)
-        except (IOError, ValueError):
-            pass
 
     def __del__(self):
         self.save()
@@ -62,29 +78,196 @@ class Cache(object):
         """Return a (time, value) tuple for a given key
         or None if the key wasn't found.
         """
-        key = str(key)
-        if key in self.cache \
-                and time.time() < self.cache[key][0] + self.expire_after \
-                and (not self.update_cache or key in self.new):
-            return self.cache[key]
-        return None
+        raise NotImplementedError()
 
     def set(self, key, value):
         """Set value for a given key."""
-        key = str(key)
-        self.cache[key] = (time.time(), value)
-        if self.update_cache:
-            self.new.add(key)
-        self.dirty = True
+        raise NotImplementedError()
+
+    def clean(self):
+        """Clean up expired entries."""
+        raise NotImplementedError()
+
+    def save(self):
+        """Save the cache."""
+        raise NotImplementedError()
+
+
+def parse_key(key):
+    """Return the tuple a cache key of the json file is the string
+    representation of, or the key itself if it isn't one.
+    """
+    if not key.startswith('('):
+        return key
+    parts = key[2:-2].split("', '")
+    # fast path for the usual keys without quotes and escapes
+    if key.startswith("('") and key.endswith("')") \
+            and '\\' not in key and '"' not in key \
+            and all("'" not in p for p in parts):
+        return tuple(parts)
+    try:
+        return ast.literal_eval(key)
+    except (ValueError, SyntaxError):
+        return key
+
+
+def unpack_score(value):
+    """Return a score unpacked from float32 as int if integral or as
+    the shortest float packing to the same float32, so 0.3 doesn't come
+    back as 0.30000001192092896 and gets saved like it was set.
+    """
+    if value.is_integer():
+        return int(value)
+    packed = struct.pack('<f', value)
+    for digits in range(6, 9):
+        short = float('%.*g' % (digits, value))
+        if struct.pack('<f', short) == packed:
+            return short
+    return float('%.9g' % value)
+
+
+class Cache(BaseCache):
+    """Load/save a dict as json from/to a file.
+
+    In memory, keys are tuples of interned strings instead of their
+    string representation and every entry is packed into bytes: the
+    time, the number of results (-1 for None) and for every result its
+    number of tags, the ids of the tags in a shared vocabulary and
+    their scores as float32, so every tag name is stored only once.
+    Scores keep float32 precision, about seven significant digits.
+    The remaining items of results and whole results that can't be
+    packed (number of tags -1) are kept by index in the other dict.
+    """
+
+    def __init__(self, path, update_cache):
+        super(Cache, self).__init__(update_cache)
+        self.fullpath = os.path.join(path, 'cache')
+        self.cache = {}
+        self.other = {}
+        self.vocab = []
+        self.vocab_ids = {}
+        try:
+            with open(self.fullpath) as file_:
+                data = json.load(file_)
+        except (IOError, ValueError):
+            data = {}
+        for key, entry in data.items():
+            # skip malformed entries, they just miss the cache
+            if isinstance(entry, list) and len(entry) == 2 \
+                    and isinstance(entry[1], (list, type(None))):
+                self._set(self._key(parse_key(key)), entry[0], entry[1])
+
+    @classmethod
+    def _key(cls, key):
+        """Return the structured in-memory key for a key."""
+        if isinstance(key, tuple):
+            return tuple(sys.intern(str(k)) for k in key)
+        return sys.intern(str(key))
+
+    def _tag_id(self, tag):
+        """Return the id of a tag in the vocabulary, add it if new."""
+        try:
+            return self.vocab_ids[tag]
+        except KeyError:
+            self.vocab.append(sys.intern(tag))
+            self.vocab_ids[tag] = len(self.vocab) - 1
+            return len(self.vocab) - 1
+
+    def _pack(self, time_, value):
+        """Return a (data, other) tuple of the packed bytes of a list of
+        results and a dict of what couldn't be packed (or None).
+        """
+        if value is None:
+            return struct.pack('<di', time_, -1), None
+        data = [struct.pack('<di', time_, len(value))]
+        other = {}
+        for index, result in enumerate(value):
+            tags = result.get('tags') if isinstance(result, dict) else None
+            if not isinstance(tags, dict) or not all(
+                    isinstance(v, (int, float)) for v in tags.values()):
+                data.append(struct.pack('<i', -1))
+                other[index] = result
+                continue
+            data.append(struct.pack('<i', len(tags)))
+            data.append(struct.pack('<%dI' % len(tags),
+                                    *(self._tag_id(k) for k in tags)))
+            data.append(struct.pack('<%df' % len(tags), *tags.values()))
+            rest = {sys.intern(k): v for k, v in result.items()
+                    if k != 'tags'}
+            if rest:
+                other[index] = rest
+        return b''.join(data), other or None
+
+    def _unpack(self, data, other=None):
+        """Return a (time, value) tuple of packed results."""
+        time_, num = struct.unpack_from('<di', data)
+        if num < 0:
+            return time_, None
+        pos = 12
+        results = []
+        for index in range(num):
+            num_tags = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+            if num_tags < 0:
+                results.append(other[index])
+                continue
+            ids = struct.unpack_from('<%dI' % num_tags, data, pos)
+            pos += 4 * num_tags
+            scores = struct.unpack_from('<%df' % num_tags, data, pos)
+            pos += 4 * num_tags
+            result = {'tags': {self.vocab[i]: unpack_score(v)
+                               for i, v in zip(ids, scores)}}
+            if other and index in other:
+                result.update(other[index])
+            results.append(result)
+        return time_, results
+
+    def _set(self, key, time_, value):
+        """Pack and set an entry while holding the lock."""
+        self.cache[key], other = self._pack(time_, value)
+        if other:
+            self.other[key] = other
+        else:
+            self.other.pop(key, None)
+
+    def _time(self, key):
+        """Return the time of an entry."""
+        return struct.unpack_from('<d', self.cache[key])[0]
+
+    def get(self, key):
+        """Return a (time, value) tuple for a given key
+        or None if the key wasn't found.
+        """
+        key = self._key(key)
+        with self.lock:
+            if key in self.cache \
+                    and time.time() < self._time(key) + self.expire_after \
+                    and (not self.update_cache or key in self.new):
+                return self._unpack(self.cache[key], self.other.get(key))
+        return None
+
+    def set(self, key, value):
+        """Set value for a given key.
+
+        :param value: list of result dicts or None
+        """
+        key = self._key(key)
+        with self.lock:
+            self._set(key, time.time(), value)
+            if self.update_cache:
+                self.new.add(key)
+            self.dirty = True
 
     def clean(self):
         """Clean up expired entries."""
         print("Cleaning cache... ", end='')
-        size = len(self.cache)
-        for key, val in list(self.cache.items()):
-            if time.time() > val[0] + self.expire_after:
-                del self.cache[key]
-                self.dirty = True
+        with self.lock:
+            size = len(self.cache)
+            for key in list(self.cache):
+                if time.time() > self._time(key) + self.expire_after:
+                    del self.cache[key]
+                    self.other.pop(key, None)
+                    self.dirty = True
         print("done! (%d entries removed)" % (size - len(self.cache)))
 
     def save(self):
@@ -93,15 +276,22 @@ class Cache(object):
         Clean expired entries before saving and use a temporary
         file to avoid data loss on interruption.
         """
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        """Save the cache while holding the lock."""
         if not self.dirty:
             return
         self.clean()
         print("Saving cache... ", end='')
         dirname, basename = os.path.split(self.fullpath)
         try:
-            with NamedTemporaryFile(mode='w',prefix=basename + '.tmp_',
+            with NamedTemporaryFile(mode='w', prefix=basename + '.tmp_',
                                     dir=dirname, delete=False) as tmpfile:
-                tmpfile.write(json.dumps(self.cache))
+                tmpfile.write(json.dumps(
+                    {str(k): self._unpack(v, self.other.get(k))
+                     for k, v in self.cache.items()}))
                 os.fsync(tmpfile)
             # seems atomic rename here is not possible on windows
             # http://docs.python.org/2/library/os.html#os.rename
@@ -115,3 +305,234 @@ class Cache(object):
         except KeyboardInterrupt:
             if os.path.isfile(tmpfile.name):
                 os.remove(tmpfile.name)
+
+
+class SqliteCache(BaseCache):
+    """Store cache entries in an indexed SQLite database.
+
+    Entries are only read when asked for and every changed row is
+    committed right away, so neither startup nor saving depends on the
+    size of the cache.  The database is in WAL mode and waits for locks
+    of other processes using it; if it stays locked, entries just
+    aren't cached.  Entries of an existing json cache file get migrated
+    once.
+    """
+
+    # seconds to wait for a lock of another process
+    timeout = 10
+
+    def __init__(self, path, update_cache):
+        super(SqliteCache, self).__init__(update_cache)
+        self.fullpath = os.path.join(path, 'cache.sqlite')
+        self.conn = sqlite3.connect(self.fullpath, timeout=self.timeout,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                          'key TEXT PRIMARY KEY, '
+                          'time REAL NOT NULL, '
+                          'value TEXT NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_time '
+                          'ON cache (time)')
+        self.conn.commit()
+        self.migrate(os.path.join(path, 'cache'))
+
+    def migrate(self, path):
+        """Import all entries of an old json cache file.
+
+        The json file gets renamed afterwards to not import it again.
+        """
+        if not os.path.isfile(path):
+            return
+        print("Migrating json cache... ", end='')
+        try:
+            with open(path) as file_:
+                data = json.load(file_)
+        except (IOError, ValueError):
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        # skip malformed entries like the json cache does
+        rows = [(key, entry[0], json.dumps(entry[1]))
+                for key, entry in data.items()
+                if isinstance(entry, list) and len(entry) == 2
+                and isinstance(entry[0], (int, float))
+                and isinstance(entry[1], (list, type(None)))]
+        error = None
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO cache (key, time, value) '
+                    'VALUES (?, ?, ?)', rows)
+        except sqlite3.Error as err:
+            error = err
+        backup_path = path + '.migrated'
+        if os.name == 'nt' and os.path.isfile(backup_path):
+            os.remove(backup_path)
+        os.rename(path, backup_path)
+        if error:
+            print("failed! (%s)" % error)
+        else:
+            print("done! (%d entries)" % len(rows))
+
+    def get(self, key):
+        """Return a (time, value) tuple for a given key
+        or None if the key wasn't found.
+        """
+        key = str(key)
+        if self.update_cache and key not in self.new:
+            return None
+        try:
+            with self.lock:
+                row = self.conn.execute(
+                    'SELECT time, value FROM cache '
+                    'WHERE key = ? AND time > ?',
+                    (key, time.time() - self.expire_after)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row:
+            return row[0], json.loads(row[1])
+        return None
+
+    def set(self, key, value):
+        """Set value for a given key."""
+        key = str(key)
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO cache (key, time, value) '
+                        'VALUES (?, ?, ?)',
+                        (key, time.time(), json.dumps(value)))
+            except sqlite3.OperationalError:
+                # locked by another process for too long, don't cache it
+                return
+            if self.update_cache:
+                self.new.add(key)
+            self.dirty = True
+
+    def clean(self):
+        """Clean up expired entries."""
+        print("Cleaning cache... ", end='')
+        try:
+            with self.lock, self.conn:
+                cursor = self.conn.execute(
+                    'DELETE FROM cache WHERE time <= ?',
+                    (time.time() - self.expire_after,))
+        except sqlite3.OperationalError as err:
+            print("failed! (%s)" % err)
+            return
+        print("done! (%d entries removed)" % max(0, cursor.rowcount))
+
+    def save(self):
+        """Clean expired entries if anything changed.
+
+        Changed entries are already committed by set(), so this only
+        reports the size of the database.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            self.clean()
+            print("Saving cache... ", end='')
+            self.time = time.time()
+            self.dirty = False
+            try:
+                size = self.conn.execute(
+                    'SELECT COUNT(*) FROM cache').fetchone()[0]
+            except sqlite3.OperationalError as err:
+                print("  failed! (%s)" % err)
+                return
+        size_mb = os.path.getsize(self.fullpath) / 2 ** 20
+        print("  done! (%d entries, %.2f MB)" % (size, size_mb))
+
+
+class SingleFlight(object):
+    """Merge concurrent calls for the same key into one call.
+
+    The first thread calling do() for a key runs the function, every
+    other thread calling do() for that key meanwhile waits for it and
+    gets the same result or exception.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        """Call func or wait for the running call for key.
+
+        Return a (result, merged) tuple, merged is True if the result
+        was shared from another call.
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            if future:
+                merged = True
+            else:
+                merged = False
+                future = self.calls[key] = Future()
+        if merged:
+            return future.result(), True
+        try:
+            result = func()
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return result, False
+
+
+class TagCache(object):
+    """Remember how raw tags get resolved and split.
+
+    Resolving tags only depends on the whitelist and the tagsfile, so
+    the results get shared by all TagLibs and saved as json for the
+    next run.  The saved results are discarded if the version (a hash
+    of the whitelist and the tagsfile) changed.
+    """
+
+    def __init__(self, path, version):
+        self.fullpath = os.path.join(path, 'tagcache')
+        self.version = version
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.data = {}
+        try:
+            with open(self.fullpath) as file_:
+                data = json.load(file_)
+            if data['version'] == version:
+                self.data = data['data']
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def __del__(self):
+        self.save()
+
+    def get(self, kind, key):
+        """Return the cached result of kind for a tag or None."""
+        return self.data.get(kind, {}).get(key)
+
+    def set(self, kind, key, value):
+        """Set the result of kind for a tag."""
+        with self.lock:
+            self.data.setdefault(kind, {})[key] = value
+            self.dirty = True
+
+    def save(self):
+        """Save the results to a file using a temporary file."""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps({'version': self.version, 'data': self.data})
+            self.dirty = False
+        dirname, basename = os.path.split(self.fullpath)
+        with NamedTemporaryFile(mode='w', prefix=basename + '.tmp_',
+                                dir=dirname, delete=False) as tmpfile:
+            tmpfile.write(data)
+        if os.name == 'nt' and os.path.isfile(self.fullpath):
+            os.remove(self.fullpath)
+        os.rename(tmpfile.name, self.fullpath)
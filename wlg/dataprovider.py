@@ -25,6 +25,7 @@ Contains classes for querying APIs of some music related sites.
 import base64
 import logging
 import os.path
+import threading
 import time
 from configparser import NoSectionError, NoOptionError
 from collections import defaultdict
@@ -32,7 +33,7 @@ from datetime import timedelta
 
 import requests
 
-from . import __version__
+from . import __version__, ratelimit
 
 try:  # use optional requests_cache if available
     import requests_cache
@@ -71,16 +72,31 @@ def factory(name, conf):
     return dapr
 
 
+def run_sync(coro):
+    """Run a query coroutine of a DataProvider to completion.
+
+    With the blocking transport of DataProvider the coroutines never
+    suspend, so they don't need an event loop.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coro.close()
+    raise RuntimeError('coroutine suspended, it needs an event loop')
+
+
 def get_stats(daprs):
     """Print some DataProvider statistics."""
     result = ['\n', 'Source stats  ',
               ''.join('| %-8s ' % d.name for d in daprs),
               '\n', '-' * 14, ('+' + '-' * 10) * len(daprs),
               '\n']
-    for key in ['reqs_err', 'reqs_web', 'reqs_cache', 'reqs_lowcache',
+    for key in ['reqs_err', 'reqs_web', 'reqs_cache', 'reqs_merged',
+                'reqs_lowcache',
                 'results', 'results_none', 'results_many', 'results/req',
                 'tags', 'tags/result', 'goodtags', 'goodtags/tag',
-                'time_resp_avg', 'time_wait_avg']:
+                'time_resp_avg', 'time_wait_avg', 'time_wait_max']:
         stats = [d.get_stats(key) for d in daprs]
         if all(stats):
             result.append('%-13s ' % key)
@@ -97,14 +113,23 @@ class DataProviderError(Exception):
 
 
 class DataProvider(object):
-    """Base class for DataProviders."""
+    """Base class for DataProviders.
+
+    The queries are implemented as coroutines (aquery_*) on top of
+    the _arequest coroutines.  Here those send blocking requests, so
+    the synchronous query_* methods simply run the coroutines.  See
+    aiodataprovider for DataProviders using an asynchronous transport.
+    """
 
     def __init__(self):
         self.log = logging.getLogger(__name__)
         self.name = self.__class__.__name__
-        self.rate_limit = 1.0  # min. seconds between requests
-        self.last_request = 0
+        self.limiter = ratelimit.RateLimiter(1.0)
+        # guards stats of albums processed concurrently
+        self.lock = threading.RLock()
         self.stats = defaultdict(float)
+        # metrics.Metrics to record the timings of requests in, if any
+        self.metrics = None
         self.session = requests.Session()
         self._setup_session()
 
@@ -115,16 +140,37 @@ class DataProvider(object):
         for prefix in ('http://', 'https://'):
             self.session.mount(prefix, adapter)
 
+    @property
+    def rate_limit(self):
+        """Min. seconds between requests."""
+        return self.limiter.interval
+
+    @rate_limit.setter
+    def rate_limit(self, value):
+        self.limiter.interval = value
+
     def _wait_rate_limit(self):
         """Wait for the rate limit."""
-        while time.time() - self.last_request < self.rate_limit:
-            self.stats['time_wait'] += .1
-            time.sleep(.1)
+        self._count_wait(self.limiter.wait())
+
+    def _count_wait(self, waited):
+        """Record the time waited for the rate limit."""
+        with self.lock:
+            self.stats['time_wait'] += waited
+            self.stats['time_wait_max'] = max(self.stats['time_wait_max'],
+                                              waited)
+        self._observe('wait', waited)
+
+    def _observe(self, stage, seconds):
+        """Record the duration of a stage in the metrics if any."""
+        if self.metrics:
+            self.metrics.observe(stage, seconds)
 
     def _request(self, url, params, method='GET'):
         """Send a request.
 
         Honor rate limits and record some timings for stats.
+        Requests served by requests_cache don't count for the rate limit.
 
         :param url: url string
         :param params: dict of call parameters
@@ -141,13 +187,15 @@ class DataProvider(object):
             raise err
         except requests.exceptions.RequestException as err:
             self.log.debug(err)
-            raise DataProviderError("request: %s" % err.message)
-        if not getattr(res, 'from_cache', False):
-            self.stats['reqs_web'] += 1
-            self.stats['time_resp'] += time.time() - time_
-            self.last_request = time_
-        else:
-            self.stats['reqs_lowcache'] += 1
+            raise DataProviderError("request: %s" % err)
+        with self.lock:
+            if not getattr(res, 'from_cache', False):
+                self.stats['reqs_web'] += 1
+                self.stats['time_resp'] += time.time() - time_
+                self._observe('http', time.time() - time_)
+            else:
+                self.stats['reqs_lowcache'] += 1
+                self.limiter.refund()
         if res.status_code not in [200, 404]:
             raise DataProviderError(
                 'status code %d: %s' % (res.status_code, res.reason))
@@ -156,11 +204,22 @@ class DataProvider(object):
     def _request_json(self, url, params, method='GET'):
         """Return a json response from a request."""
         res = self._request(url, params, method=method)
+        time_ = time.time()
         try:
-            return res.json()
+            result = res.json()
         except ValueError as err:
             self.log.debug(res.text)
-            raise DataProviderError("json request: %s" % err.message)
+            raise DataProviderError("json request: %s" % err)
+        self._observe('decode', time.time() - time_)
+        return result
+
+    async def _arequest(self, url, params, method='GET'):
+        """Send a request (coroutine)."""
+        return self._request(url, params, method)
+
+    async def _arequest_json(self, url, params, method='GET'):
+        """Return a json response from a request (coroutine)."""
+        return self._request_json(url, params, method)
 
     def _prefilter_results(self, results, name, value, func):
         """Try to prefilter results."""
@@ -179,6 +238,7 @@ class DataProvider(object):
         elif key == 'reqs_total':
             value = sum([self.stats['reqs_web'],
                          self.stats['reqs_cache'],
+                         self.stats['reqs_merged'],
                          self.stats['reqs_lowcache']])
         elif key == 'results/req' and self.get_stats('reqs_total'):
             value = self.stats['results'] / self.get_stats('reqs_total')
@@ -192,14 +252,26 @@ class DataProvider(object):
 
     def query_artist(self, artist):
         """Query for artist data."""
-        raise NotImplementedError()
+        return run_sync(self.aquery_artist(artist))
 
     def query_album(self, album, artist=None, year=None, reltyp=None):
         """Query for album data."""
-        raise NotImplementedError()
+        return run_sync(self.aquery_album(album, artist, year, reltyp))
 
     def query_by_mbid(self, entity, mbid):
         """Query by mbid."""
+        return run_sync(self.aquery_by_mbid(entity, mbid))
+
+    async def aquery_artist(self, artist):
+        """Query for artist data (coroutine)."""
+        raise NotImplementedError()
+
+    async def aquery_album(self, album, artist=None, year=None, reltyp=None):
+        """Query for album data (coroutine)."""
+        raise NotImplementedError()
+
+    async def aquery_by_mbid(self, entity, mbid):
+        """Query by mbid (coroutine)."""
         raise NotImplementedError()
 
 
@@ -274,17 +346,13 @@ class Discogs(DataProvider):
         self.conf.set('discogs', 'secret', token[1])
         self.conf.save()
 
-    def query_artist(self, artist):
-        """Query for artist data."""
-        raise NotImplementedError()
-
-    def query_album(self, album, artist=None, year=None, reltyp=None):
+    async def aquery_album(self, album, artist=None, year=None, reltyp=None):
         """Query for album data."""
         params = {'release_title': album}
         if artist:
             params.update({'artist': artist})
-        result = self._request_json('https://api.discogs.com/database/search',
-                                    params)
+        result = await self._arequest_json(
+            'https://api.discogs.com/database/search', params)
         if not result['results']:
             return None
         # merge all releases and masters
@@ -295,10 +363,6 @@ class Discogs(DataProvider):
                     tags.update(res.get(key))
         return [{'tags': {tag: 0 for tag in tags}}]
 
-    def query_by_mbid(self, entity, mbid):
-        """Query by mbid."""
-        raise NotImplementedError()
-
 
 class LastFM(DataProvider):
     """Last.FM DataProvider"""
@@ -308,12 +372,12 @@ class LastFM(DataProvider):
         # http://lastfm.de/api/tos
         self.rate_limit = .25
 
-    def _query(self, params):
+    async def _aquery(self, params):
         """Query Last.FM API."""
         params.update({'format': 'json',
                        'api_key': LASTFM_API_KEY})
-        result = self._request_json('http://ws.audioscrobbler.com/2.0/',
-                                    params)
+        result = await self._arequest_json(
+            'http://ws.audioscrobbler.com/2.0/', params)
         if 'error' in result:
             self.log.debug('%-8s error: %s', self.name, result['message'])
             return None
@@ -324,16 +388,18 @@ class LastFM(DataProvider):
             tags = {t['name']: int(t.get('count', 0)) for t in tags}
         return [{'tags': tags}]
 
-    def query_artist(self, artist):
+    async def aquery_artist(self, artist):
         """Query for artist data."""
-        return self._query({'method': 'artist.gettoptags', 'artist': artist})
+        return await self._aquery({'method': 'artist.gettoptags',
+                                   'artist': artist})
 
-    def query_album(self, album, artist=None, year=None, reltyp=None):
+    async def aquery_album(self, album, artist=None, year=None, reltyp=None):
         """Query for album data."""
-        return self._query({'method': 'album.gettoptags', 'album': album,
-                            'artist': artist or 'Various Artists'})
+        return await self._aquery({'method': 'album.gettoptags',
+                                   'album': album,
+                                   'artist': artist or 'Various Artists'})
 
-    def query_by_mbid(self, entity, mbid):
+    async def aquery_by_mbid(self, entity, mbid):
         """Query by mbid."""
         if entity == 'album':
             # FIXME: seems broken at the moment,
@@ -341,7 +407,8 @@ class LastFM(DataProvider):
             # resolve later when lastfm finished migration
             raise NotImplementedError()
         self.log.debug("%-8s %-6s use mbid '%s'.", self.name, entity, mbid)
-        return self._query({'method': entity + '.gettoptags', 'mbid': mbid})
+        return await self._aquery({'method': entity + '.gettoptags',
+                                   'mbid': mbid})
 
 
 class MusicBrainz(DataProvider):
@@ -353,10 +420,10 @@ class MusicBrainz(DataProvider):
         self.rate_limit = 2.0
         self.name = 'MBrainz'
 
-    def _query(self, path, params):
+    async def _aquery(self, path, params):
         """Query MusicBrainz."""
         params.update({'fmt': 'json', 'limit': 1})
-        result = self._request_json(
+        result = await self._arequest_json(
             'http://musicbrainz.org/ws/2/' + path, params)
         if 'error' in result:
             self.log.debug('%-8s error: %s', self.name, result['error'])
@@ -368,23 +435,23 @@ class MusicBrainz(DataProvider):
         return [{'tags': {t['name']: int(t.get('count', 0))
                           for t in r.get('tags', {})}} for r in result]
 
-    def query_artist(self, artist):
+    async def aquery_artist(self, artist):
         """Query for artist data."""
-        return self._query('artist', {'query': 'artist: ' + artist})
+        return await self._aquery('artist', {'query': 'artist: ' + artist})
 
-    def query_album(self, album, artist=None, year=None, reltyp=None):
+    async def aquery_album(self, album, artist=None, year=None, reltyp=None):
         """Query for album data."""
         qry = 'releasegroup:%s' % album
         if artist:
             qry += ' AND artist:%s' % artist
-        return self._query('release-group', {'query': qry})
+        return await self._aquery('release-group', {'query': qry})
 
-    def query_by_mbid(self, entity, mbid):
+    async def aquery_by_mbid(self, entity, mbid):
         """Query by mbid."""
         self.log.debug("%-8s %-6s use mbid '%s'.", self.name, entity, mbid)
         if entity == 'album':
             entity = 'release-group'
-        return self._query(entity + '/' + mbid, {'inc': 'tags'})
+        return await self._aquery(entity + '/' + mbid, {'inc': 'tags'})
 
 
 
@@ -471,25 +538,30 @@ class Redacted(DataProvider):
 
     def _query(self, params):
         """Query Redacted.ch API."""
-        # lazy login
+        return run_sync(self._aquery(params))
+
+    async def _aquery(self, params):
+        """Query Redacted.ch API (coroutine)."""
+        # lazy login, always blocking since it may ask for credentials
         if not self.session.cookies.get('session', None):
             self.log.debug('no session cookie, login')
             self.login()
         try:
-            result = self._request_json('https://redacted.ch/ajax.php', params)
+            result = await self._arequest_json('https://redacted.ch/ajax.php',
+                                               params)
         except requests.exceptions.TooManyRedirects:
             self.log.debug('session cookie expired, relogin')
             self.login()
-            return self._query(params)
+            return await self._aquery(params)
         try:
             response = result['response']
         except KeyError:
             raise DataProviderError('request failure')
         return response
 
-    def _query_release(self, torrent):
+    async def _aquery_release(self, torrent):
         """Query for release information"""
-        res = self._query({'action': 'torrent', 'id': torrent})
+        res = await self._aquery({'action': 'torrent', 'id': torrent})
         result = {'media': res['torrent']['media']}
         if res['torrent']['remastered']:
             year = str(res['torrent']['remasterYear'])
@@ -506,9 +578,10 @@ class Redacted(DataProvider):
                 'catalognumber': res['group']['catalogueNumber']})
         return {k: v.strip() for k, v in result.items() if v}
 
-    def query_artist(self, artist):
+    async def aquery_artist(self, artist):
         """Query for artist data."""
-        result = self._query({'action': 'artist', 'artistname': artist})
+        result = await self._aquery({'action': 'artist',
+                                     'artistname': artist})
         if not result:
             return None
         tags = {tag['name'].replace('.', ' '): tag.get('count', 0)
@@ -516,7 +589,12 @@ class Redacted(DataProvider):
         return [{'tags': tags}]
 
     def hash_query(self, hash):
-        res = self._query({'action': 'torrent', 'hash': hash.upper()})
+        """Query for album data by torrent info hash."""
+        return run_sync(self.ahash_query(hash))
+
+    async def ahash_query(self, hash):
+        """Query for album data by torrent info hash (coroutine)."""
+        res = await self._aquery({'action': 'torrent', 'hash': hash.upper()})
         result = {'tags': {t.replace('.', ' '): 0 for t in res['group']['tags']},
                   'releasetype': self.ReleaseTypeMap[str(res['group']['releaseType'])],
                   'date': str(res['group']['year'])}
@@ -535,10 +613,10 @@ class Redacted(DataProvider):
                 'catalognumber': res['group']['catalogueNumber']})
         return result
 
-    def query_album(self, album, artist=None, year=None, reltyp=None):
+    async def aquery_album(self, album, artist=None, year=None, reltyp=None):
         """Query for album data."""
-        res = self._query({'action': 'browse', 'filter_cat[1]': 1,
-                           'artistname': artist, 'groupname': album})
+        res = await self._aquery({'action': 'browse', 'filter_cat[1]': 1,
+                                  'artistname': artist, 'groupname': album})
         if not res['results']:
             return None
         res = res['results']
@@ -567,7 +645,8 @@ class Redacted(DataProvider):
             snatched = [t for t in res_['torrents'] if t['hasSnatched']]
             if len(snatched) == 1 and self.conf.args.release:
                 # 2nd query needed at the moment, wcdthread#203596
-                result.update(self._query_release(snatched[0]['torrentId']))
+                result.update(await self._aquery_release(
+                    snatched[0]['torrentId']))
             if len(res) > 1:
                 result.update({'info': '%s - %s (%s) [%s]: '
                                        'https://redacted.ch/torrents.php?id=%s'
@@ -578,8 +657,3 @@ class Redacted(DataProvider):
                                           res_['groupId'])})
             results.append(result)
         return results
-
-
-    def query_by_mbid(self, entity, mbid):
-        """Query by mbid."""
-        raise NotImplementedError()
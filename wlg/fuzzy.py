@@ -0,0 +1,73 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre fuzzy
+
+Find close matches of tags in the whitelist.
+"""
+
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+from heapq import nlargest
+
+
+class FuzzyIndex(object):
+    """Inverted character index of words to find close matches like
+    difflib.get_close_matches does.
+
+    The similarity ratio of two strings can't exceed the ratio of
+    the characters they have in common (quick_ratio in difflib).  The
+    index holds the words having a character at least n times for
+    every character and n, so the common characters of a key and all
+    words get counted at once.  Only the words that can reach the
+    cutoff get compared exactly like difflib does, so the results are
+    the same.
+    """
+
+    def __init__(self, words, cutoff=.92):
+        self.cutoff = cutoff
+        self.words = set(words)
+        self.index = defaultdict(list)
+        for word in self.words:
+            for char, num in Counter(word).items():
+                for i in range(1, num + 1):
+                    self.index[(char, i)].append(word)
+
+    def candidates(self, key):
+        """Return the words having enough characters in common with
+        key to possibly reach the cutoff.
+        """
+        if not key:
+            return [w for w in self.words if not w]
+        common = Counter()
+        for char, num in Counter(key).items():
+            for i in range(1, num + 1):
+                common.update(self.index.get((char, i), ()))
+        # same as SequenceMatcher.quick_ratio()
+        return [w for w, num in common.items()
+                if 2.0 * num / (len(key) + len(w)) >= self.cutoff]
+
+    def matches(self, key, num=1):
+        """Return a list of the best num close matches of key."""
+        matcher = SequenceMatcher()
+        matcher.set_seq2(key)
+        result = []
+        for word in self.candidates(key):
+            matcher.set_seq1(word)
+            if matcher.ratio() >= self.cutoff:
+                result.append((matcher.ratio(), word))
+        return [word for _, word in nlargest(num, result)]
@@ -0,0 +1,103 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre journal
+
+Write-behind journal of album metadata changes, used to apply all
+changes at once in directory order after the albums got queried.
+"""
+
+import json
+import os
+import threading
+
+
+class Journal(object):
+    """Append album metadata changes to a file to apply them later.
+
+    Every line of the file is a compact json record.  A change record
+    holds the path of an album and a list of [key, value] pairs to set,
+    a done record marks the changes of an album as applied.  Records
+    get synced to disk right away, so after a crash or interruption
+    the changes not applied yet are still pending.
+    """
+
+    def __init__(self, path):
+        self.fullpath = os.path.join(path, 'journal')
+        self.lock = threading.Lock()
+        self.repair()
+
+    def repair(self):
+        """Cut off a partly written last line of an interrupted run."""
+        try:
+            with open(self.fullpath, 'rb+') as file_:
+                data = file_.read()
+                if data and not data.endswith(b'\n'):
+                    file_.truncate(data.rfind(b'\n') + 1)
+        except IOError:
+            pass
+
+    def _append(self, record):
+        """Append a record to the journal file and sync it."""
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            with open(self.fullpath, 'a') as file_:
+                file_.write(line)
+                file_.flush()
+                os.fsync(file_.fileno())
+
+    def add(self, path, changes):
+        """Record changes for the album given by path.
+
+        :param path: path of the album
+        :param changes: list of (key, value) tuples for Album.set_meta
+        """
+        self._append({'path': os.path.abspath(path),
+                      'set': [list(c) for c in changes]})
+
+    def done(self, path):
+        """Mark the changes of the album given by path as applied."""
+        self._append({'path': os.path.abspath(path), 'done': True})
+
+    def pending(self):
+        """Return a dict of the changes not applied yet by album path.
+
+        The last change record of an album replaces earlier ones.
+        """
+        pending = {}
+        with self.lock:
+            try:
+                with open(self.fullpath) as file_:
+                    lines = file_.readlines()
+            except IOError:
+                return pending
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('done'):
+                pending.pop(record['path'], None)
+            else:
+                pending[record['path']] = record['set']
+        return pending
+
+    def clear(self):
+        """Remove the journal file."""
+        with self.lock:
+            if os.path.isfile(self.fullpath):
+                os.remove(self.fullpath)
@@ -22,12 +22,18 @@ Read and write metadata of audio files using mutagen.
 
 
 
+import fnmatch
 import os.path
+import queue
 import re
+import threading
 from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import mutagen
 
+from . import tagreader
+
 # supported extensions
 EXTENSIONS = ['.flac', '.ogg', '.mp3', '.m4a']
 
@@ -70,15 +76,125 @@ EasyMP4Tags.RegisterFreeformKey('media', 'MEDIA')
 EasyMP4Tags.RegisterFreeformKey('catalognumber', 'CATALOGNUMBER')
 
 
-def find_music_dirs(paths):
+def is_music_file(name):
+    """Check if a file name has a supported extension."""
+    return name.lower().endswith(tuple(EXTENSIONS))
+
+
+def find_music_dirs(paths, exclude=None):
     """Scan paths for directories containing supported music files."""
-    dirs = []
-    for path in paths:
-        for root, _, files in os.walk(path):
-            if any(os.path.splitext(f)[1].lower() in EXTENSIONS
-                   for f in files):
-                dirs.append(root)
-    return dirs
+    return list(iter_music_dirs(paths, exclude))
+
+
+def iter_music_dirs(paths, exclude=None, followlinks=False, workers=8):
+    """Scan paths for directories containing supported music files.
+
+    Directories get scanned with os.scandir by a number of worker
+    threads and are yielded as soon as they are found, in no
+    particular order.
+
+    :param paths: list of paths to scan
+    :param exclude: list of glob patterns for directory names or paths
+                    to skip
+    :param followlinks: follow symlinks to directories, every directory
+                        gets scanned only once to avoid loops
+    :param workers: number of scanning threads
+    """
+    exclude = re.compile('|'.join(fnmatch.translate(p)
+                                  for p in exclude)) if exclude else None
+    visited = set()
+    lock = threading.Lock()
+
+    def is_new(path):
+        """Check if a directory wasn't visited yet (followlinks only)."""
+        if not followlinks:
+            return True
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        key = (stat.st_dev, stat.st_ino)
+        with lock:
+            if key in visited:
+                return False
+            visited.add(key)
+        return True
+
+    def scan(path):
+        """Scan a directory, return if it contains music files and a
+        list of subdirectories to scan.
+        """
+        music = False
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=followlinks):
+                        if exclude and (exclude.match(entry.name)
+                                        or exclude.match(entry.path)):
+                            continue
+                        if not is_new(entry.path):
+                            continue
+                        subdirs.append(entry.path)
+                    elif not music and is_music_file(entry.name) \
+                            and entry.is_file():
+                        music = True
+        except OSError:
+            pass  # like os.walk, ignore unreadable directories
+        return path, music, subdirs
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = set(executor.submit(scan, p) for p in paths if is_new(p))
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, music, subdirs = future.result()
+                    pending.update(executor.submit(scan, d) for d in subdirs)
+                    if music:
+                        yield path
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class MusicDirScanner(object):
+    """Scan paths for music directories in a background thread.
+
+    Iterating yields the directories while they are found, found is
+    the number of directories found so far and done tells if the
+    scan is finished.
+    """
+
+    def __init__(self, paths, exclude=None):
+        self.found = 0
+        self.done = False
+        self.error = None
+        self.queue = queue.Queue()
+        thread = threading.Thread(target=self._scan, args=(paths, exclude))
+        thread.daemon = True
+        thread.start()
+
+    def _scan(self, paths, exclude):
+        """Put all found directories into the queue."""
+        try:
+            for path in iter_music_dirs(paths, exclude):
+                self.found += 1
+                self.queue.put(path)
+        except Exception as err:  # pylint: disable=broad-except
+            self.error = err
+        finally:
+            self.done = True
+            self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                break
+            yield path
+        if self.error:
+            raise self.error
 
 
 def is_various_artists(name, mbid):
@@ -104,6 +220,32 @@ def get_first(iterable, default=None):
     return default
 
 
+def keep_padding(info):
+    """Padding function for mutagen that keeps the existing padding
+    if the new tags fit into it.
+
+    This way only the tag block gets rewritten in place instead of
+    moving the audio data of the whole file.
+    """
+    if info.padding >= 0:
+        return info.padding
+    return info.get_default_padding()
+
+
+def map_threaded(func, items, workers):
+    """Return a list of func applied to all items using a pool of up
+    to workers threads.
+
+    The results keep the order of the items.  Nothing gets printed from
+    the pool threads, so output stays in order as well.
+    """
+    items = list(items)
+    if workers < 2 or len(items) < 2:
+        return [func(i) for i in items]
+    with ThreadPoolExecutor(min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
 class AlbumError(Exception):
     """If something went wrong while handling an Album."""
     pass
@@ -112,17 +254,27 @@ class AlbumError(Exception):
 class Album(object):
     """Class for managing albums."""
 
-    def __init__(self, path, v23sep=None):
+    def __init__(self, path, v23sep=None, workers=1):
         if not os.path.exists(path):
             raise AlbumError("Directory vanished")
         self.path = path
+        self.workers = workers
         self.tracks = []
-        for file_ in os.listdir(path):
-            if os.path.splitext(file_)[1].lower() in EXTENSIONS:
-                try:
-                    self.tracks.append(Track(path, file_, v23sep))
-                except TrackError as err:
-                    print("Error loading track '%s': %s" % (file_, err))
+        files = [f for f in os.listdir(path) if is_music_file(f)]
+
+        def load(file_):
+            """Return a (track, error) tuple."""
+            try:
+                return Track(path, file_, v23sep), None
+            except TrackError as err:
+                return None, err
+
+        for file_, (track, err) in zip(
+                files, map_threaded(load, files, workers)):
+            if err:
+                print("Error loading track '%s': %s" % (file_, err))
+            else:
+                self.tracks.append(track)
         if not self.tracks:
             raise AlbumError("Could not load any tracks")
         if not self.get_meta('album'):
@@ -181,15 +333,28 @@ class Album(object):
         for track in self.tracks:
             track.set_meta(key, val)
 
+    @property
+    def dirty(self):
+        """True if any track has unsaved changes."""
+        return any(t.dirty for t in self.tracks)
+
     def save(self):
         """Save all tracks."""
         print("Saving metadata... ", end='')
-        dirty = False
-        for track in self.tracks:
+
+        def save(track):
+            """Return a (dirty, error) tuple."""
             try:
-                dirty = track.save() or dirty
+                return track.save(), None
             except TrackError as err:
+                return False, err
+
+        dirty = False
+        for track, (saved, err) in zip(
+                self.tracks, map_threaded(save, self.tracks, self.workers)):
+            if err:
                 print("Error saving track '%s': %s" % (track.filename, err))
+            dirty = saved or dirty
         print("done!" if dirty else "(no changes)")
 
 
@@ -207,16 +372,46 @@ class Track(object):
         self.v23sep = v23sep
         self.ext = os.path.splitext(filename)[1].lower()[1:]
         self.dirty = False
+        self.stat = None
+        self._muta = None
+        # normalized metadata by key, filled on first lookup and
+        # cleared when the metadata gets changed
+        self.meta = {}
+        # tags get read from the tag blocks only, the mutagen object is
+        # loaded when the track needs to be changed
         try:
-            self.stat = os.stat(self.fullpath)
-            self.muta = mutagen.File(self.fullpath, easy=True)
+            self.tags = tagreader.read_tags(self.fullpath, self.ext)
         except (IOError, OSError) as err:
             raise TrackError(err)
-        if not self.muta:
-            raise TrackError('unknown mutagen error')
+        if self.tags is None:
+            self.tags = self.muta
+
+    @property
+    def muta(self):
+        """The mutagen object of the track, loaded on first use."""
+        if self._muta is None:
+            try:
+                self.stat = os.stat(self.fullpath)
+                muta = mutagen.File(self.fullpath, easy=True)
+            except (IOError, OSError, mutagen.MutagenError) as err:
+                raise TrackError(err)
+            if not muta:
+                raise TrackError('unknown mutagen error')
+            self._muta = self.tags = muta
+        return self._muta
 
     def get_meta(self, key):
-        """Get metadata for a given key."""
+        """Get metadata for a given key.
+
+        The result is remembered until the metadata gets changed, so
+        don't modify the returned list.
+        """
+        if key not in self.meta:
+            self.meta[key] = self._get_meta(key)
+        return self.meta[key]
+
+    def _get_meta(self, key):
+        """Read and normalize metadata for a given key from the tags."""
 
         def split(value, separators):
             """Split value by some separators."""
@@ -226,9 +421,9 @@ class Track(object):
             return [value]
 
         key = map_key(self.ext, key)
-        if not key or key not in self.muta or not self.muta[key]:
+        if not key or key not in self.tags or not self.tags[key]:
             return None
-        values = self.muta[key]
+        values = self.tags[key]
         # CSV tags
         if len(set(values)) == 1:
             sep = [self.v23sep] if self.v23sep else [';', '\n', '\\']
@@ -245,8 +440,9 @@ class Track(object):
             return
         # no val, delete key if exists
         if not val:
-            if key in self.muta:
+            if key in self.tags:
                 del self.muta[key]
+                self.meta.clear()
                 self.dirty = True
             return
         if not isinstance(val, list):
@@ -254,6 +450,7 @@ class Track(object):
         # check for change
         if val != self.get_meta(key):
             self.muta[key] = val
+            self.meta.clear()
             self.dirty = True
 
     def save(self):
@@ -265,13 +462,12 @@ class Track(object):
         """
         if not self.dirty:
             return False
+        kwargs = {'padding': keep_padding}
+        # downgrade id3 v2.4 tags to v2.3 if separator is set
+        if self.ext == 'mp3' and self.v23sep:
+            kwargs.update(v2_version=3, v23_sep=self.v23sep + ' ')
         try:
-            self.muta.save()
-            # downgrade id3 v2.4 tags to v2.3 if separator is set
-            if self.ext == 'mp3' and self.v23sep:
-                from mutagen.id3 import ID3
-                audio = ID3(self.fullpath, v2_version=3)
-                audio.save(v2_version=3, v23_sep=self.v23sep + ' ')
+            self.muta.save(**kwargs)
             # preserve modtime
             os.utime(self.fullpath, (self.stat.st_atime, self.stat.st_mtime))
         except IOError as err:
@@ -0,0 +1,143 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre metrics
+
+Record the time spent in the stages of a run and export a report of
+them as json or in the Prometheus text format.
+"""
+
+import json
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+# stages in the order they are reported
+# scan, load, metadata, score and save are timed once per album,
+# cache once per query and wait, http and decode once per request
+STAGES = ('scan', 'load', 'metadata', 'cache', 'wait', 'http', 'decode',
+          'score', 'save')
+
+QUANTILES = (.5, .95, .99)
+
+
+def quantile(values, q):
+    """Return the q-quantile of sorted values (nearest rank)."""
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values), int(math.ceil(q * len(values))))
+                      - 1)]
+
+
+class Metrics(object):
+    """Collect the durations of the stages of a run.
+
+    Every duration is kept to get exact quantiles, as doubles in an
+    array to keep it small.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = defaultdict(lambda: array('d'))
+
+    def observe(self, stage, seconds):
+        """Record the duration of a stage."""
+        with self.lock:
+            self.times[stage].append(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Context manager recording the time spent in its block."""
+        time_ = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - time_)
+
+    def summary(self):
+        """Return a dict of count, sum, max and quantiles by stage."""
+        with self.lock:
+            times = {k: sorted(v) for k, v in self.times.items()}
+        stages = list(STAGES) + sorted(set(times) - set(STAGES))
+        summary = {}
+        for stage in stages:
+            values = times.get(stage, [])
+            summary[stage] = {'count': len(values),
+                              'sum': math.fsum(values),
+                              'max': values[-1] if values else 0.0}
+            for q in QUANTILES:
+                summary[stage]['p%d' % (q * 100)] = quantile(values, q)
+        return summary
+
+
+def to_json(report):
+    """Return a report as json string."""
+    return json.dumps(report, indent=2, sort_keys=True)
+
+
+def to_prometheus(report):
+    """Return a report in the Prometheus text exposition format.
+
+    The stage timings become a summary, the numeric stats of the
+    sources and the other numbers of the report become gauges.
+    """
+
+    def name(key):
+        """Return key as valid metric name part."""
+        return re.sub(r'[^a-zA-Z0-9_]', '_', key)
+
+    lines = ['# HELP wlg_stage_seconds Time spent in a stage.',
+             '# TYPE wlg_stage_seconds summary']
+    for stage, stats in report['stages'].items():
+        for q in QUANTILES:
+            lines.append('wlg_stage_seconds{stage="%s",quantile="%s"} %r'
+                         % (stage, q, stats['p%d' % (q * 100)]))
+        lines.append('wlg_stage_seconds_sum{stage="%s"} %r'
+                     % (stage, stats['sum']))
+        lines.append('wlg_stage_seconds_count{stage="%s"} %d'
+                     % (stage, stats['count']))
+    keys = sorted(set(k for s in report['sources'].values() for k in s))
+    for key in keys:
+        lines.append('# TYPE wlg_source_%s gauge' % name(key))
+        for source, stats in sorted(report['sources'].items()):
+            if key in stats:
+                lines.append('wlg_source_%s{source="%s"} %r'
+                             % (name(key), source, float(stats[key])))
+    for key, val in sorted(report.items()):
+        if isinstance(val, (int, float)) and not isinstance(val, bool):
+            lines.append('# TYPE wlg_%s gauge' % name(key))
+            lines.append('wlg_%s %r' % (name(key), float(val)))
+    return '\n'.join(lines) + '\n'
+
+
+def write(path, data):
+    """Write data to a file using a temporary file, so readers never
+    see a partly written report.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    with NamedTemporaryFile(mode='w', prefix=basename + '.tmp_',
+                            dir=dirname, delete=False) as tmpfile:
+        tmpfile.write(data)
+    if os.name == 'nt' and os.path.isfile(path):
+        os.remove(path)
+    os.rename(tmpfile.name, path)
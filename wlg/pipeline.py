@@ -0,0 +1,227 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre pipeline
+
+Process albums in pipelined stages running in separate threads.
+"""
+
+import contextvars
+import io
+import logging
+import queue
+import sys
+import threading
+from contextlib import contextmanager
+
+
+class Job(object):
+    """State of one album passing through the pipeline."""
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.album = None
+        self.genres = None
+        self.release = None
+        self.error = None
+        self.output = io.StringIO()
+
+
+class OutputBuffer(object):
+    """Stream that redirects the output of threads working on a job
+    into the output buffer of that job.
+
+    The buffer is kept in a context variable, so threads running in a
+    copy of the context of a job write to the buffer of that job too.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = contextvars.ContextVar('buffer', default=None)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, data):
+        """Write data to the buffer of the current job if any."""
+        buffer_ = self.buffer.get()
+        if buffer_ is None:
+            return self.stream.write(data)
+        return buffer_.write(data)
+
+    def flush(self):
+        """Flush the underlying stream."""
+        self.stream.flush()
+
+    @contextmanager
+    def capture(self, buffer_):
+        """Capture the output of the current thread into buffer_."""
+        token = self.buffer.set(buffer_)
+        try:
+            yield
+        finally:
+            self.buffer.reset(token)
+
+
+class Pipeline(object):
+    """Load, query and save albums in pipelined stages.
+
+    Loading and querying run in a number of worker threads each,
+    saving is done by a single thread.  The stages are connected by
+    bounded queues.  The output of every album gets buffered and jobs
+    are yielded in the order of the given paths, so the output stays
+    the same as if the albums got processed one after another.
+    """
+
+    def __init__(self, wlg, jobs, infohash=None):
+        self.wlg = wlg
+        self.jobs = jobs
+        self.infohash = infohash
+        self.stop = threading.Event()
+        self.output = None
+
+    def _load(self, job):
+        """Load the album of a job."""
+        job.album = self.wlg.load_album(job.path)
+
+    def _query(self, job):
+        """Query genres and release info for the album of a job."""
+        if job.album:
+            with self.wlg.metrics.timer('metadata'):
+                metadata = job.album.get_metadata()
+            job.genres, job.release = self.wlg.query_album(
+                metadata, self.infohash)
+
+    def _save(self, job):
+        """Save the album of a job."""
+        if job.album:
+            self.wlg.save_album(job.album, job.genres, job.release)
+
+    def _put(self, queue_, item):
+        """Put an item into a queue unless the pipeline gets stopped."""
+        while not self.stop.is_set():
+            try:
+                queue_.put(item, timeout=.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, queue_):
+        """Get an item from a queue, return None if stopped."""
+        while not self.stop.is_set():
+            try:
+                return queue_.get(timeout=.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _feed(self, paths, outq, workers):
+        """Put a job for every path into the first queue."""
+        for index, path in enumerate(paths):
+            if self.stop.is_set():
+                return
+            self._put(outq, Job(index, path))
+        for _ in range(workers):
+            self._put(outq, None)
+
+    def _work(self, func, inq, outq, done):
+        """Run a stage function for the jobs of a queue.
+
+        Every worker forwards one end marker (None) after it has seen
+        one.  done is the number of end markers a worker has to see
+        before finishing.
+        """
+        while not self.stop.is_set():
+            job = self._get(inq)
+            if job is None:
+                done -= 1
+                if done:
+                    continue
+                self._put(outq, None)
+                return
+            if job.error is None:
+                with self.output.capture(job.output):
+                    try:
+                        func(job)
+                    except Exception:  # pylint: disable=broad-except
+                        job.error = sys.exc_info()
+            self._put(outq, job)
+
+    @contextmanager
+    def _redirect_output(self):
+        """Redirect stdout and the wlg log handlers to an OutputBuffer."""
+        stdout = sys.stdout
+        self.output = OutputBuffer(stdout)
+        handlers = [h for h in self.wlg.log.handlers
+                    if isinstance(h, logging.StreamHandler)
+                    and h.stream is stdout]
+        sys.stdout = self.output
+        for handler in handlers:
+            handler.setStream(self.output)
+        try:
+            yield
+        finally:
+            for handler in handlers:
+                handler.setStream(stdout)
+            sys.stdout = stdout
+
+    def run(self, paths):
+        """Process all paths and yield the finished jobs in order.
+
+        The output of a job needs to be written by the caller, errors
+        that occurred while processing a job get reraised.
+        """
+        load_queue = queue.Queue(self.jobs)
+        query_queue = queue.Queue(self.jobs)
+        save_queue = queue.Queue(self.jobs)
+        done_queue = queue.Queue(self.jobs)
+        threads = [threading.Thread(target=self._feed,
+                                    args=(paths, load_queue, self.jobs))]
+        for _ in range(self.jobs):
+            threads.append(threading.Thread(
+                target=self._work,
+                args=(self._load, load_queue, query_queue, 1)))
+            threads.append(threading.Thread(
+                target=self._work,
+                args=(self._query, query_queue, save_queue, 1)))
+        saver = threading.Thread(
+            target=self._work,
+            args=(self._save, save_queue, done_queue, self.jobs))
+        threads.append(saver)
+        with self._redirect_output():
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            try:
+                pending = {}
+                index = 0
+                while True:
+                    job = self._get(done_queue)
+                    if job is None:
+                        break
+                    pending[job.index] = job
+                    while index in pending:
+                        job = pending.pop(index)
+                        index += 1
+                        if job.error:
+                            raise job.error[1].with_traceback(job.error[2])
+                        yield job
+            finally:
+                # let a running save finish before returning
+                self.stop.set()
+                saver.join()
@@ -0,0 +1,320 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre profiling
+
+Profile a run with cProfile or by sampling the stacks of all threads
+and show where the time went by subsystem.
+"""
+
+import cProfile
+import inspect
+import marshal
+import os
+import pstats
+import sys
+import threading
+from collections import Counter, defaultdict
+
+# file extensions of collapsed stack files (for flame graphs)
+COLLAPSED = ('.folded', '.collapsed')
+
+# subsystems by path fragments of their modules and names of builtins
+SUBSYSTEMS = [
+    ('mediafile', ['/wlg/mediafile.py', '/wlg/tagreader.py', '/mutagen/'],
+     []),
+    ('dataprovider', ['/wlg/dataprovider.py', '/wlg/aiodataprovider.py',
+                      '/wlg/ratelimit.py', '/requests/', '/urllib3/',
+                      '/aiohttp/', '/rauth/', '/http/', '/socket.py',
+                      '/ssl.py'],
+     ['_socket.', '_ssl.', 'time.sleep']),
+    ('taglib', ['/wlg/fuzzy.py', '/difflib.py'],
+     ['re.Pattern']),
+    ('cache', ['/wlg/cache.py', '/wlg/state.py', '/wlg/journal.py',
+               '/sqlite3/'],
+     ['sqlite3.']),
+]
+
+# stack frames of idle threads, not sampled or reported, and the
+# builtins they wait in
+IDLE = ['/threading.py', '/queue.py', '/concurrent/futures/']
+IDLE_BUILTINS = ["'acquire' of '_thread.lock'",
+                 "'acquire' of '_thread.RLock'",
+                 "'get' of '_queue.SimpleQueue'"]
+
+
+# cProfile uses sys.monitoring since python 3.12, which allows only one
+# active profiler, so it can't profile every thread on its own
+PER_THREAD = sys.version_info < (3, 12)
+
+
+def factory(path):
+    """Return a profiler writing the kind of file given by path."""
+    if path.endswith(COLLAPSED) or not PER_THREAD:
+        return SamplingProfiler()
+    return Profiler()
+
+
+def taglib_range():
+    """Return (path, first line, last line) of the TagLib class."""
+    from .whatlastgenre import TagLib
+    lines, first = inspect.getsourcelines(TagLib)
+    return (os.path.normcase(inspect.getsourcefile(TagLib)), first,
+            first + len(lines) - 1)
+
+
+def subsystem(func, taglib=None):
+    """Return the name of the subsystem of a function.
+
+    :param func: (filename, line, name) tuple like pstats uses
+    :param taglib: (filename, first line, last line) of TagLib
+    """
+    filename, line, name = func
+    if taglib and os.path.normcase(filename) == taglib[0] \
+            and taglib[1] <= line <= taglib[2]:
+        return 'taglib'
+    path = filename.replace(os.sep, '/')
+    for system, paths, builtins in SUBSYSTEMS:
+        if filename == '~':
+            if any(b in name for b in builtins):
+                return system
+        elif any(p in path for p in paths):
+            return system
+    return 'other'
+
+
+def idle(func):
+    """Check if a function only waits for other threads."""
+    filename, _, name = func
+    if filename == '~':
+        return any(b in name for b in IDLE_BUILTINS)
+    return any(i in filename.replace(os.sep, '/') for i in IDLE)
+
+
+def label(func):
+    """Return a short readable label for a function."""
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+
+def report(functions, top=5):
+    """Return a report of the hottest functions grouped by subsystem.
+
+    :param functions: dict of (self time, total time) by function
+    :param top: number of functions to show for every subsystem
+    """
+    taglib = taglib_range()
+    groups = defaultdict(list)
+    for func, times in functions.items():
+        groups[subsystem(func, taglib)].append((times, func))
+    total = sum(t[0] for t in functions.values())
+    lines = ['\nProfile by subsystem (self time, total time):']
+    for system, items in sorted(
+            groups.items(), key=lambda x: -sum(t[0] for t, _ in x[1])):
+        self_time = sum(t[0] for t, _ in items)
+        lines.append('%-13s %8.2fs %5.1f%%' % (
+            system, self_time, 100 * self_time / total if total else 0))
+        for (self_, total_), func in sorted(items, reverse=True)[:top]:
+            lines.append('  %8.3fs %8.3fs  %s' % (self_, total_,
+                                                  label(func)))
+    return '\n'.join(lines)
+
+
+class ThreadProfile(cProfile.Profile):
+    """cProfile profile of one thread.
+
+    Only the thread itself may disable it, so getting its stats
+    doesn't disable it like it does for cProfile.Profile.
+    """
+
+    def create_stats(self):
+        self.snapshot_stats()
+
+
+class Profiler(object):
+    """Deterministic profiler using cProfile in every thread.
+
+    The thread calling start() and threads started while profiling get
+    their own profile, enabled and disabled by themselves, they get
+    merged into one when stopping.  Threads already running before
+    aren't profiled, threads still running after stopping keep their
+    profile until they end, but it isn't used anymore.  Needs python
+    < 3.12 (see PER_THREAD).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.profile = None
+        self.run = None
+        self.stats_ = None
+
+    def _enable(self):
+        """Enable a new profile for the current thread.
+
+        Return it or None if another profiler is active.
+        """
+        profile = ThreadProfile()
+        try:
+            profile.enable()
+        except ValueError:
+            return None
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+    def start(self):
+        """Start profiling."""
+        run = self.run = threading.Thread.run
+        enable = self._enable
+
+        def profiled_run(thread):
+            """Run a thread with its own profile."""
+            profile = enable()
+            try:
+                run(thread)
+            finally:
+                if profile:
+                    profile.disable()
+
+        threading.Thread.run = profiled_run
+        self.profile = self._enable()
+
+    def stop(self):
+        """Stop profiling, must be called by the thread that started."""
+        threading.Thread.run = self.run
+        if self.profile:
+            self.profile.disable()
+        with self.lock:
+            self.stats_ = pstats.Stats(*self.profiles)
+
+    def stats(self):
+        """Return a pstats.Stats object of all threads."""
+        return self.stats_
+
+    def functions(self):
+        """Return a dict of (self time, total time) by function,
+        without the functions idle threads wait in.
+        """
+        return {func: (stat[2], stat[3])
+                for func, stat in self.stats().stats.items()
+                if not idle(func)}
+
+    def save(self, path):
+        """Save the profile in the pstats format."""
+        self.stats().dump_stats(path)
+
+
+class SamplingProfiler(object):
+    """Profiler sampling the stacks of all threads periodically.
+
+    Idle threads waiting for work are not sampled, so time spent
+    sleeping for rate limits is counted but waiting for other threads
+    isn't.  The samples can be saved as collapsed stacks or in the
+    pstats format, with sample counts in place of call counts.
+    """
+
+    def __init__(self, interval=.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _sample(self):
+        """Sample the stacks of all other threads until stopped."""
+        ident = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            # pylint: disable=protected-access
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == ident:
+                    continue
+                code = frame.f_code
+                if idle((code.co_filename, code.co_firstlineno,
+                         code.co_name)):
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno,
+                                  code.co_name))
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        """Start sampling."""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self.stop_event.set()
+        self.thread.join()
+
+    def functions(self):
+        """Return a dict of (self time, total time) by function.
+
+        Times are estimated from the number of samples.
+        """
+        self_ = Counter()
+        total = Counter()
+        for stack, num in self.stacks.items():
+            self_[stack[-1]] += num
+            for func in set(stack):
+                total[func] += num
+        return {func: (self_[func] * self.interval, num * self.interval)
+                for func, num in total.items()}
+
+    def save(self, path):
+        """Save the samples as collapsed stacks if path ends with one of
+        COLLAPSED, otherwise in the pstats format.
+        """
+        if path.endswith(COLLAPSED):
+            self.save_collapsed(path)
+        else:
+            self.save_pstats(path)
+
+    def save_collapsed(self, path):
+        """Save the samples as collapsed stacks, one line per stack:
+        the functions from the root separated by semicolons and the
+        number of samples.
+        """
+        with open(path, 'w') as file_:
+            for stack, num in sorted(self.stacks.items()):
+                file_.write('%s %d\n' % (';'.join(label(f) for f in stack),
+                                         num))
+
+    def save_pstats(self, path):
+        """Save the samples in the format of pstats.Stats.dump_stats."""
+        stats = {}
+        for func, (self_, total) in self.functions().items():
+            num = int(round(total / self.interval))
+            stats[func] = (num, num, self_, total, {})
+        for stack, num in self.stacks.items():
+            pairs = set(zip(stack, stack[1:]))
+            for caller, func in pairs:
+                callers = stats[func][4]
+                old = callers.get(caller, (0, 0, 0.0, 0.0))
+                self_ = num * self.interval if func == stack[-1] else 0.0
+                callers[caller] = (old[0] + num, old[1] + num,
+                                   old[2] + self_,
+                                   old[3] + num * self.interval)
+        with open(path, 'wb') as file_:
+            marshal.dump(stats, file_)
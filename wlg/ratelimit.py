@@ -0,0 +1,163 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre ratelimit
+
+Token bucket rate limiters for DataProviders.
+"""
+
+import os
+import struct
+import threading
+import time
+
+try:  # file locks are not available on windows
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# sleep only this long before a deadline, spin for the rest
+SPIN_TIME = .001
+
+
+def factory(mode, interval, burst=1, path=None):
+    """Factory for RateLimiters."""
+    if mode == 'local':
+        limiter = RateLimiter(interval, burst)
+    elif mode == 'shared':
+        limiter = SharedRateLimiter(interval, burst, path)
+    else:
+        raise RateLimitError('unknown rate limit mode: %s' % mode)
+    return limiter
+
+
+def sleep_until(deadline, clock=time.monotonic):
+    """Sleep until the clock reaches deadline.
+
+    Sleep most of the time and yield for the last bit to not
+    oversleep the deadline.
+    """
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return
+        time.sleep(remaining - SPIN_TIME if remaining > SPIN_TIME else 0)
+
+
+class RateLimitError(Exception):
+    """If something went wrong with a RateLimiter."""
+    pass
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter for threads of one process.
+
+    The bucket gets refilled with one token every interval seconds and
+    holds up to burst tokens.  Every request takes one token and has to
+    wait for it if the bucket is empty.  The bucket is stored as the
+    theoretical arrival time of the next request, which allows taking
+    tokens without waiting for them while holding the lock.
+    """
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, interval, burst=1):
+        self.interval = interval
+        self.burst = max(1, burst)
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def _take(self, next_time, now):
+        """Take a token from a bucket given by next_time.
+
+        Return the new next_time and the time when the token is
+        available.
+        """
+        next_time = max(next_time, now)
+        ready = next_time - (self.burst - 1) * self.interval
+        return next_time + self.interval, max(now, ready)
+
+    def reserve(self):
+        """Take a token and return the time when it may be used."""
+        with self.lock:
+            self.next_time, ready = self._take(self.next_time, self.clock())
+        return ready
+
+    def refund(self):
+        """Give back the token of a request that didn't need it."""
+        with self.lock:
+            self.next_time = max(self.clock(),
+                                 self.next_time - self.interval)
+
+    def wait(self):
+        """Wait for a token, return the number of seconds waited."""
+        ready = self.reserve()
+        now = self.clock()
+        if ready <= now:
+            return 0
+        sleep_until(ready, self.clock)
+        return ready - now
+
+
+class SharedRateLimiter(RateLimiter):
+    """Token bucket rate limiter shared by all processes of a host.
+
+    The bucket is stored in a file that gets locked while taking or
+    refunding a token, so multiple processes using the same file share
+    one rate limit.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, interval, burst=1, path=None):
+        if not fcntl:
+            raise RateLimitError('shared rate limits need file locks')
+        if not path:
+            raise RateLimitError('shared rate limits need a path')
+        super(SharedRateLimiter, self).__init__(interval, burst)
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def __del__(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+
+    def _update(self, func):
+        """Update the next_time stored in the file using func.
+
+        func gets the stored next_time and returns the new one and
+        the result to return.
+        """
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(self.fd, 8, 0)
+                next_time = struct.unpack('d', data)[0] \
+                    if len(data) == 8 else 0
+                next_time, result = func(next_time)
+                os.pwrite(self.fd, struct.pack('d', next_time), 0)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return result
+
+    def reserve(self):
+        """Take a token and return the time when it may be used."""
+        return self._update(lambda t: self._take(t, self.clock()))
+
+    def refund(self):
+        """Give back the token of a request that didn't need it."""
+        self._update(lambda t: (max(self.clock(), t - self.interval), None))
@@ -0,0 +1,102 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre state
+
+Persistent index of the state of album directories, used to skip
+albums that didn't change since they were processed last.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .mediafile import is_music_file
+
+
+def snapshot(path):
+    """Return the state of a directory given by path.
+
+    The state consists of the mtime of the directory and a sorted
+    list of (name, mtime, size) of its music files.  It only needs
+    stat calls, no audio file gets opened.  Return None if the
+    directory vanished.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if is_music_file(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    files.append([entry.name, stat.st_mtime_ns,
+                                  stat.st_size])
+    except OSError:
+        return None
+    return mtime, sorted(files)
+
+
+class StateIndex(object):
+    """Store the state of album directories and the genres last
+    written to them in a SQLite database.
+    """
+
+    def __init__(self, path):
+        self.fullpath = os.path.join(path, 'state.sqlite')
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.fullpath, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                          'path TEXT PRIMARY KEY, '
+                          'mtime INTEGER NOT NULL, '
+                          'files TEXT NOT NULL, '
+                          'genres TEXT NOT NULL, '
+                          'time REAL NOT NULL)')
+        self.conn.commit()
+
+    def get(self, path):
+        """Return a (mtime, files, genres) tuple for a directory given
+        by path or None if it wasn't recorded yet.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT mtime, files, genres FROM state WHERE path = ?',
+                (path,)).fetchone()
+        if row:
+            return row[0], json.loads(row[1]), json.loads(row[2])
+        return None
+
+    def unchanged(self, path):
+        """Check if a directory is unchanged since it was recorded."""
+        row = self.get(path)
+        return bool(row) and snapshot(path) == row[:2]
+
+    def update(self, path, genres):
+        """Record the current state of a directory and its genres."""
+        state = snapshot(path)
+        if not state:
+            return
+        path = os.path.abspath(path)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO state '
+                '(path, mtime, files, genres, time) VALUES (?, ?, ?, ?, ?)',
+                (path, state[0], json.dumps(state[1]), json.dumps(genres),
+                 time.time()))
+            self.conn.commit()
@@ -0,0 +1,146 @@
+# whatlastgenre
+# Improves genre metadata of audio files
+# based on tags from various music sites.
+#
+# Copyright (c) 2012-2016 YetAnotherNerd
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""whatlastgenre tagreader
+
+Read tags without loading whole audio files with mutagen.
+
+Only the tag blocks get located and read, skipping stream info, audio
+frames and pictures.  Decoding the tags is still left to the tag
+classes of mutagen, so the result behaves exactly like the tags of
+the easy mutagen.File object, but loading it needs a lot less I/O.
+"""
+
+import struct
+
+import mutagen
+from mutagen._vorbis import VCommentDict
+from mutagen.easyid3 import EasyID3
+from mutagen.easymp4 import EasyMP4Tags
+from mutagen.flac import VCFLACDict
+from mutagen.id3 import BitPaddedInt, ID3NoHeaderError
+from mutagen.mp4 import Atoms
+from mutagen.ogg import OggPage
+
+# max. bytes read while looking for tags before giving up
+MAX_READ = 16 * 2 ** 20
+
+# flac metadata block types
+FLAC_VORBIS_COMMENT = 4
+FLAC_PICTURE = 6
+
+
+def read_tags(path, ext):
+    """Read the tags of an audio file.
+
+    Return a dict-like object of the tags using the keys of the easy
+    mutagen interface ({} if the file has no tags) or None if the
+    file can't be read this way and needs to be loaded with mutagen.
+
+    :param path: path of the audio file
+    :param ext: file extension (flac, ogg, mp3 or m4a)
+    """
+    readers = {'flac': read_flac, 'ogg': read_ogg,
+               'mp3': read_id3, 'm4a': read_mp4}
+    if ext not in readers:
+        return None
+    try:
+        with open(path, 'rb') as file_:
+            return readers[ext](file_)
+    except (EOFError, IndexError, ValueError, struct.error,
+            mutagen.MutagenError):
+        return None
+
+
+def read_flac(file_):
+    """Read the vorbis comment block of a flac file."""
+    header = file_.read(4)
+    if header[:3] == b'ID3':
+        # skip id3 tags like mutagen does
+        file_.seek(14 + BitPaddedInt(file_.read(6)[2:]) - 4)
+        header = file_.read(4)
+    if header != b'fLaC':
+        return None
+    last = False
+    while not last:
+        if file_.tell() > MAX_READ:
+            return None
+        head = file_.read(4)
+        if len(head) < 4:
+            return None
+        last = bool(head[0] & 0x80)
+        code = head[0] & 0x7f
+        size = int.from_bytes(head[1:], 'big')
+        if code == FLAC_VORBIS_COMMENT:
+            # the first block wins, its size is not trusted
+            return VCFLACDict(file_)
+        elif code == FLAC_PICTURE:
+            skip_flac_picture(file_)
+        else:
+            file_.seek(size, 1)
+    return {}
+
+
+def skip_flac_picture(file_):
+    """Skip a picture block, whose size is not trusted either."""
+    file_.seek(4, 1)  # picture type
+    for _ in range(2):  # mime type, description
+        file_.seek(struct.unpack('>I', file_.read(4))[0], 1)
+    file_.seek(16, 1)  # width, height, depth, colors
+    file_.seek(struct.unpack('>I', file_.read(4))[0], 1)
+
+
+def read_ogg(file_):
+    """Read the comment header of an ogg vorbis or opus file."""
+    page = OggPage(file_)
+    ident = page.packets[0]
+    if ident.startswith(b'\x01vorbis'):
+        prefix, framing = b'\x03vorbis', True
+    elif ident.startswith(b'OpusHead'):
+        prefix, framing = b'OpusTags', False
+    else:
+        return None  # other codecs, let mutagen handle them
+    serial = page.serial
+    pages = []
+    complete = False
+    while not complete:
+        if file_.tell() > MAX_READ:
+            return None
+        page = OggPage(file_)
+        if page.serial == serial:
+            pages.append(page)
+            complete = page.complete or len(page.packets) > 1
+    data = OggPage.to_packets(pages)[0]
+    if not data.startswith(prefix):
+        return None
+    return VCommentDict(data[len(prefix):], framing=framing)
+
+
+def read_id3(file_):
+    """Read the id3 tags of a mp3 file without scanning audio frames."""
+    try:
+        return EasyID3(file_)
+    except ID3NoHeaderError:
+        return {}
+
+
+def read_mp4(file_):
+    """Read the ilst atom of a mp4 file, skipping all other atom data."""
+    atoms = Atoms(file_)
+    if b'moov.udta.meta.ilst' not in atoms:
+        return {}
+    return EasyMP4Tags(atoms, file_)
@@ -22,7 +22,11 @@ https://github.com/YetAnotherNerd/whatlastgenre
 
 import configparser
 import argparse
+import contextvars
+import functools
+import hashlib
 import itertools
+import json
 import logging
 import math
 import operator
@@ -30,11 +34,15 @@ import os
 import pkgutil
 import re
 import sys
+import threading
 import time
 from collections import defaultdict, Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import timedelta
 
-from . import __version__, cache, dataprovider, mediafile
+from . import __version__, cache, dataprovider, fuzzy, journal, \
+    mediafile, metrics, pipeline, profiling, ratelimit, state
 
 Query = namedtuple(
     'Query', ['infohash', 'dapr', 'type', 'str', 'score', 'artist', 'mbid_artist',
@@ -55,10 +63,32 @@ class WhatLastGenre(object):
                            genres=Counter(),
                            reltyps=Counter())
         self.conf = conf
-        self.cache = cache.Cache(self.conf.path, self.conf.args.update_cache)
+        self.metrics = metrics.Metrics()
+        # guards stats shared between albums processed concurrently
+        self.lock = threading.RLock()
+        self.cache = self.init_cache()
+        self.singleflight = cache.SingleFlight()
+        self.state = None
+        if self.conf.args.incremental:
+            self.state = state.StateIndex(self.conf.path)
+        self.journal = None
+        if self.conf.args.journal:
+            self.journal = journal.Journal(self.conf.path)
+        self.trackworkers = 1
+        if self.conf.has_option('wlg', 'trackworkers') \
+                and self.conf.get('wlg', 'trackworkers'):
+            self.trackworkers = self.conf.getint('wlg', 'trackworkers')
         self.daprs = self.init_dataproviders()
+        # one worker per DataProvider for every concurrent album
+        self.executor = ThreadPoolExecutor(
+            len(self.daprs) * max(1, self.conf.args.jobs))
         self.whitelist = self.read_whitelist()
         self.tags = self.read_tagsfile()
+        self.tagcache = cache.TagCache(
+            self.conf.path, tags_version(self.whitelist, self.tags))
+        self.fuzzy = None
+        if self.conf.args.difflib:
+            self.fuzzy = fuzzy.FuzzyIndex(self.whitelist)
 
     def read_whitelist(self, path=None):
         """Read the whitelist trying different paths.
@@ -119,8 +149,23 @@ class WhatLastGenre(object):
         tagsfile['regex'] = regex
         self.log.debug('tagsfile:  %s (%d items)', path,
                        sum(len(v) for v in list(tagsfile.values())))
+        tagsfile['gates'] = regex_gates(regex)
+        tagsfile['prefixes'] = phrase_prefixes(itertools.chain(
+            self.whitelist, (a[0] for a in tagsfile['alias'])))
         return tagsfile
 
+    def init_cache(self):
+        """Initializes the cache backend selected in the conf file."""
+        backend = 'sqlite'
+        if self.conf.has_option('wlg', 'cache') \
+                and self.conf.get('wlg', 'cache'):
+            backend = self.conf.get('wlg', 'cache')
+        try:
+            return cache.factory(self.conf.path, self.conf.args.update_cache,
+                                 backend)
+        except cache.CacheError as err:
+            raise RuntimeError(err)
+
     def init_dataproviders(self):
         """Initializes the DataProviders activated in the conf file."""
         daprs = []
@@ -129,31 +174,75 @@ class WhatLastGenre(object):
                 daprs.append(dataprovider.factory(dapr, self.conf))
             except dataprovider.DataProviderError as err:
                 self.log.warn('%s: %s', dapr, err)
+        for dapr in daprs:
+            dapr.metrics = self.metrics
+        self.init_rate_limiters(daprs)
         if not daprs:
             raise RuntimeError(
                 'Where do you want to get your data from? At least one source '
                 'must be activated! (multiple sources recommended)')
         return daprs
 
+    def init_rate_limiters(self, daprs):
+        """Set up the rate limiters of DataProviders as configured in the
+        ratelimit section of the conf file.
+        """
+        mode, burst = 'local', 1
+        if self.conf.has_option('ratelimit', 'mode') \
+                and self.conf.get('ratelimit', 'mode'):
+            mode = self.conf.get('ratelimit', 'mode')
+        if self.conf.has_option('ratelimit', 'burst') \
+                and self.conf.get('ratelimit', 'burst'):
+            burst = self.conf.getint('ratelimit', 'burst')
+        for dapr in daprs:
+            path = os.path.join(self.conf.path,
+                                'ratelimit_' + dapr.name.lower())
+            try:
+                dapr.limiter = ratelimit.factory(mode, dapr.rate_limit,
+                                                 burst, path)
+            except ratelimit.RateLimitError as err:
+                raise RuntimeError(err)
+
     def progress_path(self, path, infohash = None):
         """Create an Album object for a directory given by path to read and
         write metadata from/to.  Query top genre tags by album metadata,
         update metadata with results and save the album (its tracks).
         """
-        # create album object to read and write metadata
-        try:
-            album = mediafile.Album(path, self.conf.get('wlg', 'id3v23sep'))
-        except mediafile.AlbumError as err:
-            self.stat_message(logging.ERROR, str(err), path, 1)
+        album = self.load_album(path)
+        if not album:
             return
-        # read album metadata
-        metadata = album.get_metadata()
+        with self.metrics.timer('metadata'):
+            metadata = album.get_metadata()
         # query genres (and releasetype) for album metadata
         genres, release = self.query_album(metadata, infohash)
-        # update album metadata
+        self.save_album(album, genres, release)
+
+    def load_album(self, path):
+        """Create an Album object to read and write metadata.
 
+        Return None if the album could not be loaded or is unchanged
+        since the last run in incremental mode.
+        """
+        if self.state and self.state.unchanged(path):
+            print("Unchanged since last run, skipping.")
+            self.stat_message(logging.DEBUG, 'Unchanged since last run',
+                              path)
+            return None
+        try:
+            with self.metrics.timer('load'):
+                return mediafile.Album(path,
+                                       self.conf.get('wlg', 'id3v23sep'),
+                                       self.trackworkers)
+        except mediafile.AlbumError as err:
+            self.stat_message(logging.ERROR, str(err), path, 1)
+            return None
+
+    def save_album(self, album, genres, release):
+        """Update album metadata with the results and save the album."""
+        changes = []
         if genres:
             album.set_meta('genre', genres)
+            changes.append(('genre', genres))
             print("Genres:  %s" % ', '.join(genres).encode('utf-8'))
         if release and self.conf.args.release:
             release_info = []
@@ -161,13 +250,68 @@ class WhatLastGenre(object):
                         'edition', 'media']:
                 if key in release and release[key]:
                     album.set_meta(key, release[key])
+                    changes.append((key, release[key]))
                     release_info.append(release[key])
             print("Release: %s" % ' / '.join(release_info))
         # save metadata to all tracks
         if self.conf.args.dry:
             print("DRY-RUN! Not saving metadata.")
+        elif self.journal:
+            # gets applied by flush_journal
+            if album.dirty:
+                self.journal.add(album.path, changes)
+                print("Metadata journaled.")
+            else:
+                print("Metadata unchanged.")
         else:
-            album.save()
+            with self.metrics.timer('save'):
+                album.save()
+            # remember albums with genres to skip them next time
+            if self.state and genres:
+                self.state.update(album.path, genres)
+
+    def save_caches(self):
+        """Save the cache and the tag cache.
+
+        Call this when done, don't rely on __del__ being called.
+        """
+        self.cache.save()
+        self.tagcache.save()
+
+    def flush_journal(self):
+        """Apply the journaled metadata changes to the albums.
+
+        Albums get saved in the order of their paths to access the disk
+        sequentially.  Every applied album gets marked as done, so an
+        interrupted flush continues with the remaining albums.
+        """
+        pending = self.journal.pending()
+        if not pending:
+            return
+        if self.conf.args.dry:
+            print("\nDRY-RUN! Not applying %d journaled albums."
+                  % len(pending))
+            return
+        print("\nApplying %d journaled albums..." % len(pending))
+        for path in sorted(pending):
+            print(path)
+            try:
+                album = mediafile.Album(path,
+                                        self.conf.get('wlg', 'id3v23sep'),
+                                        self.trackworkers)
+            except mediafile.AlbumError as err:
+                self.stat_message(logging.ERROR, str(err), path, 1)
+                self.journal.done(path)
+                continue
+            for key, val in pending[path]:
+                album.set_meta(key, val)
+            with self.metrics.timer('save'):
+                album.save()
+            genres = dict(pending[path]).get('genre')
+            if self.state and genres:
+                self.state.update(album.path, genres)
+            self.journal.done(path)
+        self.journal.clear()
 
     def query_album(self, metadata, infohash=None):
         """Query for top genres of an album identified by metadata
@@ -186,84 +330,99 @@ class WhatLastGenre(object):
                       metadata.type, metadata.albumartist[0], metadata.album,
                       metadata.year, (" (%d artists)" % num_artists
                                       if num_artists > 1 else ''))
-        taglib = TagLib(self.conf, self.whitelist, self.tags)
+        taglib = TagLib(self.conf, self.whitelist, self.tags, self.tagcache,
+                        self.fuzzy)
         release = None
-        for query in self.create_queries(metadata, infohash):
-            if not query.str:
-                continue
-            try:
-                results, cached = self.cached_query(query)
-            except NotImplementedError:
+        time_score = 0.0
+        queries = [q for q in self.create_queries(metadata, infohash)
+                   if q.str]
+        for query, (results, cached, err) in zip(
+                queries, self.fetch_queries(queries)):
+            if isinstance(err, NotImplementedError):
                 continue
-            except dataprovider.DataProviderError as err:
-                query.dapr.stats['reqs_err'] += 1
+            elif err:
+                with self.lock:
+                    query.dapr.stats['reqs_err'] += 1
                 self.stat_message(logging.ERROR, '%-8s %-6s error: %s'
                                   % (query.dapr.name, query.type, err),
                                   metadata.path, 1)
                 continue
-            if not results:
-                query.dapr.stats['results_none'] += 1
-                if query.type == 'album' or num_artists == 1:
-                    self.stat_message(logging.DEBUG, '%s: no %s results'
-                                      % (query.dapr.name, query.type),
-                                      metadata.path)
-                self.log.info(log_string(query, cached, "no results"))
-                continue
-            # ask user if appropriated
-            if len(results) > 1 and not self.conf.args.dry \
-                    and self.conf.args.release \
-                    and query.dapr.name.lower() == 'redacted' \
-                    and query.type == 'album' \
-                    and len(set(r.get('releasetype') for r in results)) > 1:
-                results = ask_user(query.dapr.name, query.type, results)
-                if len(results) == 1:
-                    self.cache.set(self.cache.cachekey(query), results)
-            # merge multiple results
-            if len(results) in range(2, 6):
-                results = [self.merge_results(results)]
-            # too many results
-            if len(results) > 1:
-                query.dapr.stats['results_many'] += 1
-                if query.type == 'album' or num_artists == 1:
-                    self.stat_message(logging.DEBUG, '%s: too many %s results'
-                                      % (query.dapr.name, query.type),
-                                      metadata.path)
-                self.log.info(log_string(query, cached,
-                                         "%2d results" % len(results)))
-                continue
-            # unique result
-            query.dapr.stats['results'] += 1
-            # tags
-            if 'tags' in results[0] and results[0]['tags']:
-                tags = taglib.score(results[0]['tags'], query.score)
-                good = taglib.add(tags, query.type)
-                if self.conf.args.difflib:
-                    matched = {}
-                    for old, new in taglib.difflib_matching(tags):
-                        self.stat_message(
-                            logging.WARN, 'possible aliases found by difflib',
-                            '%s = %s' % (old, new))
-                        matched.update({new: tags[old]})
-                    good += taglib.add(matched, query.type)
-                query.dapr.stats['tags'] += len(tags)
-                query.dapr.stats['goodtags'] += good
-                status = "%2d of %2d tags" % (good, len(tags))
-            else:
-                status = "no    tags"
-            # release info
-            if query.dapr.name.lower() == 'redacted' and (query.type == 'album' or query.type == 'hash'):
-                if 'releasetype' in results[0] and results[0]['releasetype']:
-                    self.stats.reltyps[results[0]['releasetype']] += 1
-                    release = {k: v for k, v in results[0].items()
-                               if k not in ['info', 'tags']}
-                elif self.conf.args.release:
-                    self.stat_message(logging.ERROR, 'No releaseinfo found',
-                                      metadata.path, 1)
-            self.log.info(log_string(query, cached, status))
-
+            with self.lock:
+                if not results:
+                    query.dapr.stats['results_none'] += 1
+                    if query.type == 'album' or num_artists == 1:
+                        self.stat_message(logging.DEBUG, '%s: no %s results'
+                                          % (query.dapr.name, query.type),
+                                          metadata.path)
+                    self.log.info(log_string(query, cached, "no results"))
+                    continue
+                # ask user if appropriated
+                if len(results) > 1 and not self.conf.args.dry \
+                        and self.conf.args.release \
+                        and self.conf.args.jobs < 2 \
+                        and query.dapr.name.lower() == 'redacted' \
+                        and query.type == 'album' \
+                        and len(set(r.get('releasetype')
+                                    for r in results)) > 1:
+                    results = ask_user(query.dapr.name, query.type, results)
+                    if len(results) == 1:
+                        self.cache.set(self.cache.cachekey(query), results)
+                # merge multiple results
+                if len(results) in range(2, 6):
+                    results = [self.merge_results(results)]
+                # too many results
+                if len(results) > 1:
+                    query.dapr.stats['results_many'] += 1
+                    if query.type == 'album' or num_artists == 1:
+                        self.stat_message(logging.DEBUG,
+                                          '%s: too many %s results'
+                                          % (query.dapr.name, query.type),
+                                          metadata.path)
+                    self.log.info(log_string(query, cached,
+                                             "%2d results" % len(results)))
+                    continue
+                # unique result
+                query.dapr.stats['results'] += 1
+                # tags
+                if 'tags' in results[0] and results[0]['tags']:
+                    time_ = time.time()
+                    tags = taglib.score(results[0]['tags'], query.score)
+                    good = taglib.add(tags, query.type)
+                    if self.conf.args.difflib:
+                        matched = {}
+                        for old, new in taglib.difflib_matching(tags):
+                            self.stat_message(
+                                logging.WARN,
+                                'possible aliases found by difflib',
+                                '%s = %s' % (old, new))
+                            matched.update({new: tags[old]})
+                        good += taglib.add(matched, query.type)
+                    time_score += time.time() - time_
+                    query.dapr.stats['tags'] += len(tags)
+                    query.dapr.stats['goodtags'] += good
+                    status = "%2d of %2d tags" % (good, len(tags))
+                else:
+                    status = "no    tags"
+                # release info
+                if query.dapr.name.lower() == 'redacted' \
+                        and query.type in ['album', 'hash']:
+                    if 'releasetype' in results[0] \
+                            and results[0]['releasetype']:
+                        self.stats.reltyps[results[0]['releasetype']] += 1
+                        release = {k: v for k, v in results[0].items()
+                                   if k not in ['info', 'tags']}
+                    elif self.conf.args.release:
+                        self.stat_message(logging.ERROR,
+                                          'No releaseinfo found',
+                                          metadata.path, 1)
+                self.log.info(log_string(query, cached, status))
+
+        time_ = time.time()
         genres = taglib.get_genres(num_artists > 1)
+        self.metrics.observe('score', time_score + time.time() - time_)
         if genres:
-            self.stats.genres.update(genres)
+            with self.lock:
+                self.stats.genres.update(genres)
             for group in ['artist', 'album']:
                 if not taglib.taggrps[group]:
                     self.stat_message(logging.INFO, 'No %s tags' % group,
@@ -273,13 +432,124 @@ class WhatLastGenre(object):
                               metadata.path, 1)
         return genres, release
 
+    def fetch_queries(self, queries):
+        """Perform cached queries, queries for different DataProviders
+        run concurrently.
+
+        Queries for one DataProvider run one after another in the given
+        order.  Return a list of (results, cached, error) tuples in the
+        order of the queries.
+        """
+
+        def fetch(indexes):
+            """Perform the queries given by indexes one by one."""
+            for index in indexes:
+                try:
+                    results[index] = \
+                        self.cached_query(queries[index]) + (None,)
+                except (NotImplementedError,
+                        dataprovider.DataProviderError) as err:
+                    results[index] = (None, False, err)
+
+        results = [None] * len(queries)
+        groups = defaultdict(list)
+        for index, query in enumerate(queries):
+            groups[query.dapr].append(index)
+        if len(groups) < 2:
+            fetch(range(len(queries)))
+            return results
+        # copy the context to keep the output of pipelined albums
+        futures = [self.executor.submit(contextvars.copy_context().run,
+                                        fetch, indexes)
+                   for indexes in groups.values()]
+        for future in futures:
+            future.result()
+        return results
+
+    def plan_queries(self, paths, infohash=None):
+        """Create the queries of all albums given by paths up front.
+
+        Return a list of the unique queries that are not cached yet
+        and a dict of query counts by DataProvider name.
+        """
+        seen = set()
+        misses = []
+        counts = defaultdict(Counter)
+        for path in paths:
+            if self.state and self.state.unchanged(path):
+                continue
+            try:
+                album = mediafile.Album(path,
+                                        self.conf.get('wlg', 'id3v23sep'),
+                                        self.trackworkers)
+            except mediafile.AlbumError:
+                continue  # gets reported when processing the album
+            for query in self.create_queries(album.get_metadata(), infohash):
+                if not query.str:
+                    continue
+                count = counts[query.dapr.name]
+                count['queries'] += 1
+                cachekey = self.cache.cachekey(query)
+                if cachekey in seen:
+                    continue
+                seen.add(cachekey)
+                count['unique'] += 1
+                if self.cache.get(cachekey):
+                    count['cached'] += 1
+                else:
+                    count['requests'] += 1
+                    misses.append(query)
+        return misses, counts
+
+    def print_plan(self, counts):
+        """Print the query counts of a plan and the estimated time
+        needed for the requests.
+        """
+        daprs = [d for d in self.daprs if d.name in counts]
+        print('\nQuery plan    '
+              + ''.join('| %-8s ' % d.name for d in daprs))
+        print('-' * 14 + ('+' + '-' * 10) * len(daprs))
+        for key in ['queries', 'unique', 'cached', 'requests']:
+            print('%-13s ' % key
+                  + ''.join('| %8d ' % counts[d.name][key] for d in daprs))
+        # DataProviders run concurrently, each with its own rate limit
+        secs = max([counts[d.name]['requests'] * d.rate_limit
+                    for d in daprs] or [0])
+        print('\nEstimated time for %d requests: %s'
+              % (sum(c['requests'] for c in counts.values()),
+                 timedelta(seconds=int(secs))))
+
+    def prefetch(self, queries):
+        """Perform the queries of a plan to fill the cache.
+
+        Return the number of failed queries.
+        """
+        return sum(1 for _, _, err in self.fetch_queries(queries)
+                   if err and not isinstance(err, NotImplementedError))
+
     def cached_query(self, query):
-        """Perform a cached DataProvider query."""
+        """Perform a cached DataProvider query.
+
+        Identical queries running concurrently are merged into one,
+        the others wait for its result.
+        """
         cachekey = self.cache.cachekey(query)
+        (res, cached), merged = self.singleflight.do(
+            cachekey, lambda: self._cached_query(query, cachekey))
+        if merged:
+            with self.lock:
+                query.dapr.stats['reqs_merged'] += 1
+            cached = True
+        return res, cached
+
+    def _cached_query(self, query, cachekey):
+        """Perform a cached DataProvider query without merging."""
         # check cache
-        res = self.cache.get(cachekey)
+        with self.metrics.timer('cache'):
+            res = self.cache.get(cachekey)
         if res:
-            query.dapr.stats['reqs_cache'] += 1
+            with self.lock:
+                query.dapr.stats['reqs_cache'] += 1
             return res[1], True
         # no cache hit
         res = self.query(query)
@@ -387,7 +657,8 @@ class WhatLastGenre(object):
 
     def stat_message(self, level, message, item, log=None):
         """Record a message in the stats and optionally log it."""
-        self.stats.messages[(level, message)].append(item)
+        with self.lock:
+            self.stats.messages[(level, message)].append(item)
         if log:
             if log > 1:
                 message += ': ' + item
@@ -421,16 +692,41 @@ class WhatLastGenre(object):
         print("\nTime elapsed: %s (%s per directory)\n"
               % (timedelta(seconds=diff), timedelta(seconds=diff / num_dirs)))
 
+    def stats_report(self, num_dirs):
+        """Return a dict of the stats and stage timings of the run for
+        the machine-readable reports.
+        """
+        with self.lock:
+            genres = dict(self.stats.genres)
+            messages = {msg: len(items) for (_, msg), items
+                        in self.stats.messages.items()}
+            sources = {d.name.lower(): dict(d.stats) for d in self.daprs}
+        return {'version': __version__,
+                'started': self.stats.time,
+                'elapsed': time.time() - self.stats.time,
+                'albums': num_dirs,
+                'genres': genres,
+                'messages': messages,
+                'sources': sources,
+                'stages': self.metrics.summary()}
+
 
 class TagLib(object):
     """Class to handle tags."""
 
-    def __init__(self, conf, whitelist, tags):
+    def __init__(self, conf, whitelist, tags, tagcache=None, fuzzyindex=None):
         self.log = logging.getLogger(__name__)
         self.conf = conf
         self.whitelist = whitelist
+        self.tagcache = tagcache
+        self.fuzzy = fuzzyindex
         self.aliases = tags['alias']
         self.regexes = tags['regex']
+        self.gates = tags.get('gates')
+        self.prefixes = tags.get('prefixes')
+        if self.prefixes is None:
+            self.prefixes = phrase_prefixes(
+                itertools.chain(whitelist, self.aliases))
         self.upper = tags['upper']
         self.taggrps = {'artist': defaultdict(float),
                         'album': defaultdict(float)}
@@ -498,7 +794,21 @@ class TagLib(object):
     def resolve(self, key):
         """Try to resolve a tag to a valid whitelisted tag by using
         aliases, regex replacements and optional difflib matching.
+
+        Results are taken from and added to the tagcache if any.
         """
+        if not self.tagcache:
+            return self._resolve(key)
+        resolved = self.tagcache.get('resolve', key)
+        if resolved is None:
+            resolved = self._resolve(key)
+            self.tagcache.set('resolve', key, resolved)
+        elif resolved != key:
+            self.log.debug('tag resolve %s -> %s (cached)', key, resolved)
+        return resolved
+
+    def _resolve(self, key):
+        """Resolve a tag without using the tagcache."""
 
         def alias(key):
             """Return whether a key got an alias and log it if True."""
@@ -512,31 +822,117 @@ class TagLib(object):
         if alias(key):
             return self.aliases[key]
         # regex
-        if any(r[0].search(key) for r in self.regexes):
-            for pat, repl in self.regexes:
-                if pat.search(key):
-                    key_ = key
-                    key = pat.sub(repl, key)
-                    self.log.debug('tag replace %s -> %s (%s)',
-                                   key_, key, pat.pattern)
+        index = self.next_regex(key)
+        if index is not None:
+            # apply all matching regexes in order
+            while index is not None:
+                pat, repl = self.regexes[index]
+                key_ = key
+                key = pat.sub(repl, key)
+                self.log.debug('tag replace %s -> %s (%s)',
+                               key_, key, pat.pattern)
+                index = self.next_regex(key, index + 1)
             # key got replaced, try alias again
             if alias(key):
                 return self.aliases[key]
             return key
         return key
 
+    def may_resolve(self, key):
+        """Return whether a tag is whitelisted or could be changed by
+        an alias or regex, i.e. if it may resolve to a whitelisted tag.
+        """
+        if key in self.whitelist or key in self.aliases:
+            return True
+        return self.may_replace(key)
+
+    def may_replace(self, key):
+        """Return whether any regex matches a tag."""
+        if self.gates:
+            return bool(self.gates[0][0].search(key))
+        return any(r[0].search(key) for r in self.regexes)
+
+    def next_regex(self, key, start=0):
+        """Return the index of the first regex from start on that
+        matches key or None if no regex matches.
+
+        Uses the combined patterns of the tagsfile if available, which
+        only need one search per position where any regex matches.
+        """
+        if start >= len(self.regexes):
+            return None
+        if not self.gates:
+            for index in range(start, len(self.regexes)):
+                if self.regexes[index][0].search(key):
+                    return index
+            return None
+        gate, rules = self.gates[start]
+        first = None
+        pos = 0
+        while True:
+            match = gate.search(key, pos)
+            if not match:
+                return first
+            index = rules[match.lastindex]
+            if first is None or index < first:
+                first = index
+            if first == start or match.start() >= len(key):
+                return first
+            pos = match.start() + 1
+
     def difflib_matching(self, tags):
-        """Use difflib to find some whitelist matches."""
-        from difflib import get_close_matches
+        """Find some whitelist matches like difflib does."""
         for key in tags.keys():
             if key not in self.whitelist and key not in self.aliases:
-                match = get_close_matches(key, self.whitelist, 1, .92)
+                match = self.fuzzy_match(key)
                 if match:
-                    self.log.debug('tag match   %s -> %s', key, match[0])
-                    yield key, match[0]
+                    self.log.debug('tag match   %s -> %s', key, match)
+                    yield key, match
+
+    def fuzzy_match(self, key):
+        """Return the closest whitelist match of a tag or None.
+
+        Results, including tags without a match, are taken from and
+        added to the tagcache if any.
+        """
+        if self.tagcache:
+            match = self.tagcache.get('fuzzy', key)
+            if match is not None:
+                return match or None
+        if not self.fuzzy:
+            self.fuzzy = fuzzy.FuzzyIndex(self.whitelist)
+        matches = self.fuzzy.matches(key, 1)
+        match = matches[0] if matches else None
+        if self.tagcache:
+            self.tagcache.set('fuzzy', key, match or '')
+        return match
 
     def split(self, key, val, group):
         """Split a tag into its parts and add them."""
+        if not self.tagcache:
+            keys, flag, splitup = self.split_parts(key)
+        else:
+            parts = self.tagcache.get('split', key)
+            if parts is None:
+                parts = self.split_parts(key)
+                self.tagcache.set('split', key, parts)
+            keys, flag, splitup = parts
+        good = 0
+        base = val
+        if splitup:
+            base = val * self.conf.getfloat('scores', 'splitup')
+        # add the parts
+        if keys:
+            self.log.debug('tag split   %s -> %s', key, ', '.join(keys))
+            good = self.add({k: val * .5 for k in keys}, group, flag)
+        return good, base
+
+    def split_parts(self, key):
+        """Return the parts a tag gets split into.
+
+        Return a (keys, flag, splitup) tuple, flag tells if the parts
+        may be split again and splitup if the splitup score applies.
+        """
 
         def dont_split(key):
             """Return whether key may be split."""
@@ -550,30 +946,61 @@ class TagLib(object):
             return False
 
         keys = []
-        good = 0
-        base = val
         flag = True
+        splitup = False
         if '/' in key:  # all delimiters got replaced with / earlier
             keys = [k.strip() for k in key.split('/') if len(k.strip()) > 2]
             flag = False
         elif ' ' in key and not dont_split(key):
             keys = [k.strip() for k in key.split(' ') if len(k.strip()) > 2]
             if len(keys) > 2:
-                # build all combinations with length 1 to 3, requires
-                # at least 3 words, permutations would be overkill
-                combis = []
-                for length in range(1, min(4, len(keys))):
-                    for combi in itertools.combinations(keys, length):
-                        combis.append(' '.join(combi))
-                keys = combis
-            base = val * self.conf.getfloat('scores', 'splitup')
+                keys = self.combinations(keys)
+            splitup = True
         elif '-' in key and key not in self.whitelist:
             keys = [k.strip() for k in key.split('-') if len(k.strip()) > 2]
-        # add the parts
-        if keys:
-            self.log.debug('tag split   %s -> %s', key, ', '.join(keys))
-            good = self.add({k: val * .5 for k in keys}, group, flag)
-        return good, base
+        return keys, flag, splitup
+
+    def combinations(self, words):
+        """Return the combinations of 1 to 3 words (in order) that may
+        resolve to a whitelisted tag, requires at least 3 words.
+
+        Combinations that would get filtered after resolving anyway
+        aren't built: words and word pairs get checked, but 3 words
+        only get combined from the pairs that start a whitelisted
+        phrase or alias and from the words and pairs a regex matches,
+        which also matches the combination.  A regex only matching
+        across all 3 words (like '.*top.*[0-9]+.*') isn't considered.
+        """
+        num = len(words)
+        singles = [self.may_replace(w) for w in words]
+        combis = set((i,) for i, word in enumerate(words)
+                     if singles[i] or word in self.whitelist
+                     or word in self.aliases)
+        pairs = {}
+        for i, j in itertools.combinations(range(num), 2):
+            pair = words[i] + ' ' + words[j]
+            pairs[i, j] = self.may_replace(pair)
+            if pairs[i, j] or pair in self.whitelist or pair in self.aliases:
+                combis.add((i, j))
+            if num < 4:
+                continue
+            # whitelisted phrases and aliases
+            if pair in self.prefixes:
+                for k in range(j + 1, num):
+                    phrase = pair + ' ' + words[k]
+                    if phrase in self.whitelist or phrase in self.aliases:
+                        combis.add((i, j, k))
+        if num > 3:
+            # every combination containing a word or pair that matches
+            for i in (i for i in range(num) if singles[i]):
+                others = [j for j in range(num) if j != i]
+                combis.update(tuple(sorted((i,) + c)) for c in
+                              itertools.combinations(others, 2))
+            for (i, j) in (p for p, match in pairs.items() if match):
+                combis.update((h, i, j) for h in range(i))
+                combis.update((i, j, k) for k in range(j + 1, num))
+        return [' '.join(words[i] for i in combi)
+                for combi in sorted(combis, key=lambda c: (len(c), c))]
 
     def merge(self, various):
         """Merge all tag groups using different score modifiers."""
@@ -654,6 +1081,8 @@ class Config(configparser.SafeConfigParser):
             ('wlg', 'tagsfile', ''),
             ('wlg', 'vaqueries', 'true'),
             ('wlg', 'id3v23sep', ''),
+            ('wlg', 'cache', 'sqlite'),
+            ('wlg', 'trackworkers', '4'),
             ('genres', 'love', ''),
             ('genres', 'hate', 'alternative, electronic, indie, pop, rock'),
             ('scores', 'artist', '1.33'),
@@ -664,6 +1093,8 @@ class Config(configparser.SafeConfigParser):
             ('scores', 'src_lastfm', '0.66'),
             ('scores', 'src_mbrainz', '0.66'),
             ('scores', 'src_redacted', '1.50'),
+            ('ratelimit', 'mode', 'local'),
+            ('ratelimit', 'burst', '1'),
             ('discogs', 'token', ''),
             ('discogs', 'secret', ''),
             ('redacted', 'username', ''),
@@ -760,16 +1191,133 @@ def preprocess_tags(tags):
     return tags
 
 
+def tags_version(whitelist, tags):
+    """Return a hash identifying a whitelist and tagsfile."""
+    data = json.dumps([sorted(whitelist), tags['alias'], tags['upper'],
+                       [(r[0].pattern, r[1]) for r in tags['regex']]])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def has_alternation(pattern):
+    """Check if a regex pattern has an alternation outside of groups."""
+    depth = 0
+    charset = None  # index of the first char of the current set
+    escaped = False
+    for i, char in enumerate(pattern):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif charset is not None:
+            # a ] or ^ as first char is part of the set
+            if char == '^' and i == charset and pattern[i - 1] == '[':
+                charset += 1
+            elif char == ']' and i > charset:
+                charset = None
+        elif char == '[':
+            charset = i + 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and not depth:
+            return True
+    return False
+
+
+def phrase_prefixes(phrases):
+    """Return the set of word prefixes of phrases, like 'drum and' of
+    'drum and bass', without the phrases themselves.
+    """
+    prefixes = set()
+    for phrase in phrases:
+        if not isinstance(phrase, str):
+            continue
+        words = phrase.split(' ')
+        for i in range(1, len(words)):
+            prefixes.add(' '.join(words[:i]))
+    return prefixes
+
+
+def regex_gates(regexes):
+    """Combine a list of (pattern, replacement) regex tuples.
+
+    Return a list with a (pattern, rules) tuple for every index i of
+    regexes.  The pattern combines all patterns from index i on in one
+    alternation, rules maps its group numbers to the indexes of the
+    regexes.  A match of the combined pattern at a position tells the
+    first regex matching at that position.  The word boundaries the
+    tagsfile patterns are wrapped in get factored out to speed up the
+    search, unless they only belong to the first and last branch of an
+    alternation.  Return None if the patterns can't be combined, e.g.
+    because of backreferences or different flags.
+    """
+    if not regexes or any(
+            not r[0].flags & re.I
+            or re.search(r'\\[1-9]|\(\?P=', r[0].pattern)
+            for r in regexes):
+        return None
+    gates = []
+    try:
+        for start in range(len(regexes)):
+            parts, rules, bounded = [], {}, []
+            group = 0
+            for index in range(start, len(regexes)):
+                pat = regexes[index][0]
+                inner = pat.pattern
+                is_bounded = inner.startswith(r'\b') \
+                    and inner.endswith(r'\b') \
+                    and not inner.endswith(r'\\b') \
+                    and not has_alternation(inner[2:-2])
+                if is_bounded:
+                    inner = inner[2:-2]
+                group += 1
+                rules[group] = index
+                group += pat.groups
+                if is_bounded:
+                    bounded.append('(%s)' % inner)
+                    continue
+                if bounded:
+                    parts.append(r'\b(?:%s)\b' % '|'.join(bounded))
+                    bounded = []
+                parts.append('(%s)' % inner)
+            if bounded:
+                parts.append(r'\b(?:%s)\b' % '|'.join(bounded))
+            gates.append((re.compile('|'.join(parts), re.I), rules))
+    except re.error:
+        return None
+    return gates
+
+
+# patterns removed from search strings in this order, each with a tuple
+# of strings that all need to be present for the pattern to match
+SEARCHSTR_PATTERNS = [
+    (re.compile(r'\(.*\)$'), ('(', ')')),
+    (re.compile(r'\[.*\]'), ('[', ']')),
+    (re.compile('{.*}'), ('{', '}')),
+    (re.compile('- .* -'), ('- ', ' -')),
+    (re.compile("'.*'"), ("'",)),
+    (re.compile('".*"'), ('"',)),
+    (re.compile(' (- )?(album|single|ep|official remix(es)?|soundtrack|ost)$'),
+     (' ',)),
+    (re.compile(r'[ \(]f(ea)?t(\.|uring)? .*'), ('f', 't')),
+    (re.compile(r'vol(\.|ume)? '), ('vol',)),
+    (re.compile('[!?/:;,]'), ()),
+    (re.compile(' +'), ('  ',)),
+]
+
+
+@functools.lru_cache(maxsize=4096)
 def searchstr(str_):
     """Clean up a string for use in searching."""
     if not str_:
         return ''
     str_ = str_.lower()
-    for pat in [r'\(.*\)$', r'\[.*\]', '{.*}', "- .* -", "'.*'", '".*"',
-                ' (- )?(album|single|ep|official remix(es)?|soundtrack|ost)$',
-                r'[ \(]f(ea)?t(\.|uring)? .*', r'vol(\.|ume)? ',
-                '[!?/:;,]', ' +']:
-        sub = re.sub(pat, ' ', str_).strip()
+    for pat, triggers in SEARCHSTR_PATTERNS:
+        if all(t in str_ for t in triggers):
+            sub = pat.sub(' ', str_).strip()
+        else:  # can't match
+            sub = str_.strip()
         if sub:  # don't remove everything
             str_ = sub
     return str_
@@ -827,6 +1375,14 @@ def progressbar(current, total):
            + '] %2.0f%%' % math.floor(100 * prog)
 
 
+def progresscounter(current, found, done):
+    """Return a progress string for a number of found directories that
+    is still growing unless done.
+    """
+    return '(%d/%d%s) %s' % (current, found, '' if done else '+',
+                             'scan finished' if done else 'scanning...')
+
+
 def read_datafile(path):
     """Read a file that might be package data."""
     if path.startswith('data/'):
@@ -870,8 +1426,35 @@ def get_args():
     parser.add_argument('-r', '--release', action='store_true',
                         help='get release info from redacted')
     parser.add_argument('-d', '--difflib', action='store_true',
-                        help='enable difflib matching (slow)')
+                        help='enable difflib matching')
     parser.add_argument('--hash', "-I", action='store_true', help="torrent hash to query redacted with")
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of albums processed concurrently '
+                             '(disables interactivity)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('-p', '--plan', action='store_true',
+                      help='plan and prefetch all queries before '
+                           'processing the albums')
+    mode.add_argument('-s', '--stream', action='store_true',
+                      help='process albums while scanning for them '
+                           '(unsorted)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip albums unchanged since they got genres')
+    parser.add_argument('--journal', action='store_true',
+                        help='journal all changes and save them after '
+                             'processing all albums')
+    parser.add_argument('-x', '--exclude', metavar='GLOB', action='append',
+                        help='skip directories matching GLOB by name or path '
+                             '(can be given multiple times)')
+    parser.add_argument('--stats-json', metavar='FILE',
+                        help='write stats and stage timings as json to FILE')
+    parser.add_argument('--stats-prometheus', metavar='FILE',
+                        help='write stats and stage timings in the '
+                             'Prometheus text format to FILE')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run and write the profile to FILE '
+                             '(collapsed stacks of samples if FILE ends with '
+                             '.folded or .collapsed, pstats otherwise)')
 
     return parser.parse_args()
 
@@ -887,20 +1470,70 @@ def main():
     args = get_args()
     conf = Config(args)
     wlg = WhatLastGenre(conf)
-    paths = mediafile.find_music_dirs(args.path)
-    print("\nFound %d music directories!" % len(paths))
-    if not paths:
-        return
+    if args.stream:
+        paths = mediafile.MusicDirScanner(args.path, args.exclude)
+
+        def progress(current):
+            """Return a progress string for streamed directories."""
+            return progresscounter(current, paths.found, paths.done)
+    else:
+        with wlg.metrics.timer('scan'):
+            paths = sorted(mediafile.find_music_dirs(args.path, args.exclude))
+        print("\nFound %d music directories!" % len(paths))
+        if not paths:
+            return
+
+        def progress(current):
+            """Return a progress string for the listed directories."""
+            return progressbar(current, len(paths))
+    profiler = None
+    if args.profile:
+        profiler = profiling.factory(args.profile)
+        profiler.start()
     i = 1
     try:
-        for i, path in enumerate(sorted(paths), start=1):
-            print('\n' + progressbar(i, len(paths)))
-            print(path)
-            if args.hash:
-                wlg.progress_path(path, args.hash)
-            else:
-                wlg.progress_path(path)
+        if args.plan:
+            print("\nPlanning queries...", end='')
+            queries, counts = wlg.plan_queries(paths, args.hash or None)
+            print(" done!")
+            wlg.print_plan(counts)
+            if queries:
+                print("\nPrefetching %d queries..." % len(queries), end='')
+                sys.stdout.flush()
+                errors = wlg.prefetch(queries)
+                print(" done! (%d errors)" % errors if errors else " done!")
+        if args.jobs > 1:
+            pipe = pipeline.Pipeline(wlg, args.jobs, args.hash or None)
+            with closing(pipe.run(paths)) as jobs:
+                for i, job in enumerate(jobs, start=1):
+                    print('\n' + progress(i))
+                    print(job.path)
+                    sys.stdout.write(job.output.getvalue())
+        else:
+            for i, path in enumerate(paths, start=1):
+                print('\n' + progress(i))
+                print(path)
+                if args.hash:
+                    wlg.progress_path(path, args.hash)
+                else:
+                    wlg.progress_path(path)
+        if args.stream:
+            print("\nFound %d music directories!" % paths.found)
+        if wlg.journal:
+            wlg.flush_journal()
         print('\n...all done!')
     except KeyboardInterrupt:
         print()
+    if profiler:
+        profiler.stop()
+        profiler.save(args.profile)
     wlg.print_stats(i)
+    if profiler:
+        print(profiling.report(profiler.functions()))
+        print("\nProfile written to %s" % args.profile)
+    if args.stats_json:
+        metrics.write(args.stats_json, metrics.to_json(wlg.stats_report(i)))
+    if args.stats_prometheus:
+        metrics.write(args.stats_prometheus,
+                      metrics.to_prometheus(wlg.stats_report(i)))
+    wlg.save_caches()